@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Load test: /metrics scrape latency of the health-check HTTP server under concurrent clients.
+
+By default main.py's server is started in-process on a free port with --models synthetic
+models in every family; pass --url to load an already running instance instead. Each
+client scrapes over its own keep-alive connection, while --stalled clients open a
+connection and stop mid-request (the case a single-threaded server cannot survive),
+--idle keep-alive connections make one scrape and then stay open without sending more, and
+--flood connections are opened and left idle without ever sending a request.
+"""
+import time
+import socket
+import logging
+import argparse
+import threading
+import http.client
+import urllib.parse
+
+def start_server(models, workers, backlog):
+    """Serve main.py's handler with synthetic results on 127.0.0.1; returns its base URL."""
+    import main
+    main.logger.setLevel(logging.WARNING)
+    for family, _, _, _ in main.FAMILIES:
+        results = [{"model": f"org/model-{i}", "success": True, "ttft": 0.1 + i / 1000,
+                    "phases": {"dns": 0.001, "connect": 0.01, "tls": 0.02, "ttfb": 0.08, "first_token": 0.1}}
+                   for i in range(models)]
+        main.store_results(family, results, None)
+    server = main.BoundedThreadingHTTPServer(("127.0.0.1", 0), main.MetricsHandler, max_workers=workers, max_backlog=backlog)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def scrape(url, requests, latencies, statuses, lock):
+    """Scrape /metrics `requests` times over one keep-alive connection."""
+    parts = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        try:
+            conn.request("GET", "/metrics", headers={"Accept-Encoding": "gzip"})
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+            status = "error"
+        with lock:
+            latencies.append(time.perf_counter() - t0)
+            statuses[status] = statuses.get(status, 0) + 1
+    conn.close()
+
+def open_connections(url, count, partial):
+    """Open `count` connections that send `partial` and then go silent."""
+    parts = urllib.parse.urlsplit(url)
+    sockets = []
+    for _ in range(count):
+        sock = socket.create_connection((parts.hostname, parts.port))
+        if partial:
+            sock.sendall(partial)
+        sockets.append(sock)
+    return sockets
+
+def idle_connections(url, count):
+    """Open `count` keep-alive connections that make one scrape and then stay idle."""
+    parts = urllib.parse.urlsplit(url)
+    conns = []
+    for _ in range(count):
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        conn.request("GET", "/metrics")
+        conn.getresponse().read()
+        conns.append(conn)
+    return conns
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test /metrics scrapes of the health-check server")
+    parser.add_argument("--url", help="Base URL of a running health-check (default: start one in-process)")
+    parser.add_argument("--models", type=int, default=200, help="Synthetic models per family of the in-process server")
+    parser.add_argument("--workers", type=int, default=8, help="HTTP worker threads of the in-process server")
+    parser.add_argument("--backlog", type=int, default=64, help="Connections that may wait for a worker in the in-process server")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent keep-alive scrape clients")
+    parser.add_argument("--requests", type=int, default=50, help="Scrapes per client")
+    parser.add_argument("--stalled", type=int, default=1, help="Clients that stop in the middle of a request")
+    parser.add_argument("--idle", type=int, default=8, help="Keep-alive connections left idle after one scrape")
+    parser.add_argument("--flood", type=int, default=0, help="Extra idle connections opened before the scrapes")
+    args = parser.parse_args()
+
+    url = args.url or start_server(args.models, args.workers, args.backlog)
+    held = open_connections(url, args.stalled, b"GET /metrics HTTP/1.1\r\nHost: x\r\n")
+    held += open_connections(url, args.flood, b"")
+    idle = idle_connections(url, args.idle)
+    time.sleep(0.1)
+
+    latencies, statuses, lock = [], {}, threading.Lock()
+    clients = [threading.Thread(target=scrape, args=(url, args.requests, latencies, statuses, lock)) for _ in range(args.clients)]
+    t0 = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - t0
+    for sock in held:
+        sock.close()
+    for conn in idle:
+        conn.close()
+
+    latencies.sort()
+    def pct(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(f"{len(latencies)} scrapes by {args.clients} clients in {elapsed:.2f} s "
+          f"({args.stalled} stalled, {args.idle} idle keep-alive, {args.flood} idle new connections)")
+    print(f"latency p50 {pct(0.5):.1f} ms, p99 {pct(0.99):.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+    print("status " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str)))
+
+if __name__ == "__main__":
+    main()
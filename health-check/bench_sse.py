@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: SSEParser (probe_engine.read_chat_stream) against the previous
+readline/decode/json.loads loop, on recorded chat completion streams.
+
+By default a vLLM-style stream is synthesized; pass --file to replay a captured raw
+stream body instead, e.g. the output of
+    curl -sN https://.../v1/chat/completions -d '{"stream": true, ...}' > stream.txt
+"""
+import io
+import json
+import time
+import argparse
+
+from probe_engine import PhaseTimer, read_chat_stream
+
+def record_stream(tokens):
+    """Return a vLLM-style SSE stream body with `tokens` content chunks and a usage report."""
+    def event(obj):
+        return b"data: " + json.dumps(obj).encode("utf-8") + b"\n\n"
+
+    base = {"id": "chatcmpl-0123456789abcdef", "object": "chat.completion.chunk", "created": 1760000000, "model": "swiss-ai/Apertus-70B-Instruct-2509"}
+    events = [event(dict(base, choices=[{"index": 0, "delta": {"role": "assistant", "content": ""}, "logprobs": None, "finish_reason": None}]))]
+    for i in range(tokens):
+        events.append(event(dict(base, choices=[{"index": 0, "delta": {"content": f" {i + 1}"}, "logprobs": None, "finish_reason": None}])))
+    events.append(event(dict(base, choices=[], usage={"prompt_tokens": 18, "completion_tokens": tokens, "total_tokens": tokens + 18})))
+    events.append(b"data: [DONE]\n\n")
+    return events
+
+class RecordedSocket(io.RawIOBase):
+    """Raw stream handing out one recorded network segment per read, like a socket."""
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.index = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.index >= len(self.segments):
+            return 0
+        segment = self.segments[self.index]
+        n = min(len(b), len(segment))
+        b[:n] = segment[:n]
+        if n < len(segment):
+            self.segments[self.index] = segment[n:]
+        else:
+            self.index += 1
+        return n
+
+def replay(segments):
+    return io.BufferedReader(RecordedSocket(list(segments)))
+
+def legacy_read_chat_stream(response, timer, full_stream=False):
+    """The loop used before SSEParser: readline, decode, strip and json.loads per line."""
+    ttft = None
+    while True:
+        line = response.readline()
+        if not line:
+            return None, None, None
+        line_str = line.decode('utf-8').strip()
+        if line_str.startswith('data:'):
+            data_str = line_str[5:].strip()
+            if data_str == '[DONE]':
+                return None, None, None
+            try:
+                data = json.loads(data_str)
+                choices = data.get('choices', [])
+                if choices:
+                    delta = choices[0].get('delta', {})
+                    if delta.get('content') or delta.get('reasoning_content') or delta.get('text') or delta:
+                        ttft = timer.mark("first_token")
+                        break
+            except json.JSONDecodeError:
+                pass
+
+    usage = None
+    arrivals = [timer.last] if full_stream else None
+    while True:
+        line = response.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line.startswith(b'data:'):
+            continue
+        data = line[5:].strip()
+        if data == b'[DONE]':
+            response.read()
+            break
+        if arrivals is not None:
+            now = time.perf_counter()
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            if chunk.get('choices') and chunk['choices'][0].get('delta'):
+                arrivals.append(now)
+            usage = chunk.get('usage') or usage
+        elif b'"usage"' in data:
+            try:
+                usage = json.loads(data).get('usage') or usage
+            except ValueError:
+                pass
+    return ttft, usage, arrivals
+
+def bench(reader, segments, full_stream, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(20):
+            ttft, usage, _ = reader(replay(segments), PhaseTimer(), full_stream)
+        best = min(best, (time.perf_counter() - start) / 20)
+    assert ttft is not None and usage is not None
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SSE stream parsing for probes")
+    parser.add_argument("--tokens", type=int, default=256, help="Content chunks in the synthesized stream")
+    parser.add_argument("--file", help="Replay a recorded raw SSE stream body instead")
+    parser.add_argument("--segment", type=int, default=0, help="Split the stream into reads of this many bytes (default: one event per read)")
+    parser.add_argument("--repeat", type=int, default=20, help="Timing repetitions; the best is reported")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            body = f.read()
+        events = [e + b"\n\n" for e in body.split(b"\n\n") if e.strip()]
+    else:
+        events = record_stream(args.tokens)
+    if args.segment:
+        body = b"".join(events)
+        segments = [body[i:i + args.segment] for i in range(0, len(body), args.segment)]
+    else:
+        segments = events
+
+    print(f"{len(events)} events, {sum(map(len, events))} bytes, {len(segments)} reads")
+    for full_stream in (False, True):
+        legacy = bench(legacy_read_chat_stream, segments, full_stream, args.repeat)
+        current = bench(read_chat_stream, segments, full_stream, args.repeat)
+        mode = "full-stream" if full_stream else "first token + usage"
+        print(f"{mode:<20} legacy {legacy * 1e6:9.1f} us   parser {current * 1e6:9.1f} us   {legacy / current:5.2f}x")
+
+if __name__ == "__main__":
+    main()
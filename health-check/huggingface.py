@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 import os
-import ssl
 import sys
-import time
 import json
+import time
 import argparse
 import subprocess
 import urllib.request
 import urllib.error
+import functools
 import concurrent.futures
 
+from probe_engine import FULL_STREAM_REQUEST, connection_state, probe_chat_stream, run_probes, set_deadline, ssl_context, timed_urlopen
+from sharding import shard_filter
+
 def load_env(env_path, verbose=True):
     """Load environment variables from a .env file."""
     if not os.path.exists(env_path):
@@ -27,35 +30,60 @@ def load_env(env_path, verbose=True):
                 val = val.strip().strip('"').strip("'")
                 os.environ[key] = val
 
-def get_models_from_api(token, ssl_verify=True):
-    """Fetch Public AI partner models directly from Hugging Face API."""
-    base_url = "https://huggingface.co"
+def get_models_from_api(token, ssl_verify=True, cache_path=None, ttl=900, base_url="https://huggingface.co"):
+    """Fetch Public AI partner models directly from Hugging Face API.
+
+    The staging and live lists are fetched concurrently on the probe engine's keep-alive
+    connections. With `cache_path`, lists fetched less than `ttl` seconds ago are reused
+    without a request and older ones are revalidated with conditional requests.
+    """
     endpoint = "/api/partners/publicai/models"
     status_list = ["staging", "live"]
-    models = set()
-    
-    for s in status_list:
+
+    cache = {}
+    if cache_path:
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+    context = ssl_context(ssl_verify)
+    now = time.time()
+
+    def fetch(s):
+        entry = cache.get(s)
+        if entry and now - entry.get("fetched_at", 0) < ttl:
+            return entry
+
         url = f"{base_url}{endpoint}?status={s}"
         headers = {}
         if token:
             headers["Authorization"] = f"Bearer {token}"
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
             
         req = urllib.request.Request(url, headers=headers, method='GET')
         
-        if not ssl_verify:
-            context = ssl.create_default_context()
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-        else:
-            context = None
-            
         try:
-            with urllib.request.urlopen(req, context=context, timeout=30) as response:
-                data = json.loads(response.read().decode('utf-8'))
+            with timed_urlopen(req, context=context, timeout=30) as response:
+                body = response.read()
+                if response.status == 304 and entry:
+                    return dict(entry, fetched_at=now)
+                data = json.loads(body.decode('utf-8'))
+                models = set()
                 for category, category_models in data.items():
                     if isinstance(category_models, dict):
                         for hf_model_id in category_models.keys():
                             models.add(hf_model_id)
+                return {
+                    "models": sorted(models),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "fetched_at": now
+                }
         except urllib.error.HTTPError as e:
             try:
                 error_body = e.read().decode('utf-8')
@@ -64,11 +92,31 @@ def get_models_from_api(token, ssl_verify=True):
                 raise RuntimeError(f"HTTP Error {e.code}: {e.reason}")
         except Exception as e:
             raise RuntimeError(f"Failed to fetch models for status '{s}': {e}")
-            
-    return sorted(list(models))
 
-def measure_ttft(base_url, model_id, token, ssl_verify=True):
-    """Call the Hugging Face router chat completion and measure Time to First Token (TTFT)."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(status_list)) as executor:
+        entries = dict(zip(status_list, executor.map(fetch, status_list)))
+
+    if cache_path and entries != {s: cache.get(s) for s in status_list}:
+        try:
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Could not write partner model cache {cache_path}: {e}", file=sys.stderr)
+
+    models = set()
+    for entry in entries.values():
+        models.update(entry["models"])
+    return sorted(models)
+
+def measure_ttft(base_url, model_id, token, ssl_verify=True, full_stream=False):
+    """Call the Hugging Face router chat completion and measure Time to First Token (TTFT).
+
+    Returns (success, ttft, error, phases, usage, stream) where phases holds the per-phase
+    timings, usage the token usage reported at the end of the stream and stream the
+    decode stats of a full-stream probe (None otherwise).
+    """
     url = f"{base_url.rstrip('/')}/chat/completions"
     
     # Model name format expected by router.huggingface.co
@@ -80,8 +128,11 @@ def measure_ttft(base_url, model_id, token, ssl_verify=True):
             {"role": "user", "content": "Respond with a single word hello"}
         ],
         "stream": True,
+        "stream_options": {"include_usage": True},
         "max_tokens": 10
     }
+    if full_stream:
+        payload.update(FULL_STREAM_REQUEST)
     
     headers = {
         "Content-Type": "application/json",
@@ -91,65 +142,23 @@ def measure_ttft(base_url, model_id, token, ssl_verify=True):
         "X-HF-Bill-To": "current-ai-official"
     }
     
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(payload).encode('utf-8'),
-        headers=headers,
-        method='POST'
-    )
-    
-    if not ssl_verify:
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-    else:
-        context = None
+    context = ssl_context(ssl_verify)
         
-    t0 = time.time()
-    try:
-        # 30-second timeout to establish connection and receive stream
-        with urllib.request.urlopen(req, context=context, timeout=30) as response:
-            while True:
-                line = response.readline()
-                if not line:
-                    break
-                line_str = line.decode('utf-8').strip()
-                if line_str.startswith('data:'):
-                    data_str = line_str[5:].strip()
-                    if data_str == '[DONE]':
-                        break
-                    try:
-                        data = json.loads(data_str)
-                        choices = data.get('choices', [])
-                        if choices:
-                            delta = choices[0].get('delta', {})
-                            # Check for any generated content/token
-                            if delta.get('content') or delta.get('reasoning_content') or delta.get('text') or delta:
-                                ttft = time.time() - t0
-                                return True, ttft, None
-                    except json.JSONDecodeError:
-                        pass
-                        
-            return False, None, "Response stream ended without any tokens"
-            
-    except urllib.error.HTTPError as e:
-        try:
-            error_body = e.read().decode('utf-8')
-            return False, None, f"HTTP Error {e.code}: {e.reason} - Details: {error_body}"
-        except Exception:
-            return False, None, f"HTTP Error {e.code}: {e.reason}"
-    except urllib.error.URLError as e:
-        return False, None, f"URL Error: {e.reason}"
-    except Exception as e:
-        return False, None, f"Exception: {type(e).__name__} - {str(e)}"
+    return probe_chat_stream(url, payload, headers, context=context, timeout=30, full_stream=full_stream)
 
 def main():
     parser = argparse.ArgumentParser(description="Test Hugging Face Router endpoints for partner models")
     parser.add_argument("--insecure", action="store_true", help="Bypass SSL verification")
     parser.add_argument("--url", default="https://router.huggingface.co/v1", help="Base URL of Hugging Face router")
     parser.add_argument("--workers", type=int, default=5, help="Number of parallel workers to use")
+    parser.add_argument("--models", help="Comma-separated list of models to test (default: all)")
+    parser.add_argument("--shard", help="Only probe the models this replica owns on the hash ring of --shard-members (see sharding.py)")
+    parser.add_argument("--shard-members", default="", help="Comma-separated replicas sharing the models, with --shard")
+    parser.add_argument("--full-stream", action="store_true", help="Read every stream to the end and report decode speed")
+    parser.add_argument("--deadline", type=float, default=0, help="Seconds the whole run may take; unfinished probes are reported as timeout (0: no limit)")
     parser.add_argument("-json", "--json", action="store_true", help="Output results in JSON format")
     args = parser.parse_args()
+    set_deadline(args.deadline)
 
     json_mode = args.json
 
@@ -177,19 +186,32 @@ def main():
         log(f"SSL verification: {'ENABLED' if ssl_verify else 'DISABLED'}")
         log("Finding models on Hugging Face account via API...")
         
-        models = get_models_from_api(token, ssl_verify=ssl_verify)
+        models = get_models_from_api(
+            token,
+            ssl_verify=ssl_verify,
+            cache_path=os.environ.get("HF_MODELS_CACHE", "/tmp/hf-partner-models.json"),
+            ttl=float(os.environ.get("HF_MODELS_TTL", 900))
+        )
         
         if not models:
             raise RuntimeError("No models found on Hugging Face account.")
             
         log(f"Found {len(models)} models: {', '.join(models)}")
+        if args.models:
+            wanted = set(args.models.split(","))
+            models = [m for m in models if m in wanted]
+            log(f"Restricting tests to {len(models)} requested models")
+        if args.shard:
+            owns = shard_filter(args.shard, args.shard_members)
+            models = [m for m in models if owns(m)]
+            log(f"Restricting tests to the {len(models)} models of shard {args.shard}")
         log(f"Testing {len(models)} models in parallel using {args.workers} workers...")
         log("-" * 120)
         
         results = [None] * len(models)
         
         def test_single_model(idx, model):
-            success, ttft, error = measure_ttft(args.url, model, token, ssl_verify=ssl_verify)
+            success, ttft, error, phases, usage, stream = measure_ttft(args.url, model, token, ssl_verify=ssl_verify, full_stream=args.full_stream)
             if success:
                 log(f"[{idx}/{len(models)}] {model}: SUCCESS (TTFT: {ttft:.3f}s)")
             else:
@@ -198,24 +220,34 @@ def main():
                 'model': model,
                 'success': success,
                 'ttft': ttft,
+                'phases': phases,
+                'connection': connection_state(phases),
+                'usage': usage,
+                'stream': stream,
                 'error': error
             }
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
-            futures = {executor.submit(test_single_model, idx, model): idx - 1 for idx, model in enumerate(models, 1)}
-            for future in concurrent.futures.as_completed(futures):
-                idx_zero = futures[future]
-                try:
-                    results[idx_zero] = future.result()
-                except Exception as e:
-                    model = models[idx_zero]
-                    log(f"[{idx_zero+1}/{len(models)}] {model}: FAILED (Exception: {e})")
-                    results[idx_zero] = {
-                        'model': model,
-                        'success': False,
-                        'ttft': None,
-                        'error': f"Thread Exception: {e}"
-                    }
+        tasks = [functools.partial(test_single_model, idx, model) for idx, model in enumerate(models, 1)]
+        for idx_zero, (status, value) in enumerate(run_probes(tasks, args.workers)):
+            model = models[idx_zero]
+            if status == "done":
+                results[idx_zero] = value
+            elif status == "error":
+                log(f"[{idx_zero+1}/{len(models)}] {model}: FAILED (Exception: {value})")
+                results[idx_zero] = {
+                    'model': model,
+                    'success': False,
+                    'ttft': None,
+                    'error': f"Thread Exception: {value}"
+                }
+            else:
+                log(f"[{idx_zero+1}/{len(models)}] {model}: TIMEOUT (run deadline of {args.deadline:g}s reached)")
+                results[idx_zero] = {
+                    'model': model,
+                    'success': False,
+                    'ttft': None,
+                    'error': f"timeout: probe did not finish within the {args.deadline:g}s run deadline"
+                }
         
         failures = [r for r in results if not r['success']]
         
@@ -0,0 +1,138 @@
+import time
+
+def parse_hours(spec):
+    """Parse "7-22" (UTC hours, end exclusive, may wrap past midnight) into (start, end).
+
+    An empty spec means all day and returns None.
+    """
+    if not spec or not spec.strip():
+        return None
+    start, end = (int(part) % 24 for part in spec.split("-", 1))
+    return start, end
+
+class KeepWarm:
+    """Learn after how much idle time each (family, model) cold-starts and ping it just before.
+
+    A successful probe is a cold start if its TTFT exceeds `cold_factor` times the model's
+    median TTFT, and the median by at least `cold_min_seconds`. Every probe is recorded
+    with the idle time since the previous request we sent to the model; the threshold is
+    the shortest idle time from which at least half of the probes were cold starts, once
+    `min_cold` cold starts were seen. Within `hours` (UTC) a model is due for a keep-warm
+    ping once it has been idle for `margin` times its threshold, as long as the pings of
+    the day stay within `daily_tokens` (0 disables pinging; thresholds are still learned).
+    """
+
+    def __init__(self, cold_factor=3.0, cold_min_seconds=1.0, min_cold=2, margin=0.8, history=64, daily_tokens=0, hours=None):
+        self.cold_factor = cold_factor
+        self.cold_min_seconds = cold_min_seconds
+        self.min_cold = min_cold
+        self.margin = margin
+        self.history = history
+        self.daily_tokens = daily_tokens
+        self.hours = hours
+        self.last_seen = {}  # (family, model) -> timestamp of the last request we sent
+        self.observations = {}  # (family, model) -> [(idle seconds, cold start)], oldest first
+        self.thresholds = {}  # (family, model) -> learned idle seconds before a cold start
+        self.cold_starts = {}  # (family, model) -> number of probes classified as cold starts
+        self.ping_tokens = {}  # (family, model) -> tokens the last probe of the model used
+        self.spent = 0
+        self.pings = 0
+        self.day = None
+
+    def is_cold(self, ttft, baseline):
+        return ttft > self.cold_factor * baseline and ttft - baseline >= self.cold_min_seconds
+
+    def observe_run(self, family, results, baselines, now):
+        """Record one family run; `baselines` maps (model, api_base) -> median TTFT (missing if
+        too few samples), api_base being "" except for supplier results.
+
+        Sets "cold_start" on each successful result that could be classified.
+        """
+        previous = {}
+        tokens = {}
+        for r in results:
+            key = (family, r.get("model", ""))
+            if key not in previous:
+                previous[key] = self.last_seen.get(key)
+                self.last_seen[key] = now
+            # A model with several deployments (suppliers) is pinged on all of them
+            usage = r.get("usage") or {}
+            tokens[key] = tokens.get(key, 0) + (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+            baseline = baselines.get((key[1], r.get("api_base", "")))
+            ttft = r.get("ttft")
+            if not r.get("success", False) or ttft is None or not baseline or previous[key] is None:
+                continue
+            cold = self.is_cold(ttft, baseline)
+            r["cold_start"] = cold
+            if cold:
+                self.cold_starts[key] = self.cold_starts.get(key, 0) + 1
+            observations = self.observations.setdefault(key, [])
+            observations.append((now - previous[key], cold))
+            del observations[:-self.history]
+            threshold = self.learn(observations)
+            if threshold is None:
+                self.thresholds.pop(key, None)
+            else:
+                self.thresholds[key] = threshold
+        self.ping_tokens.update((key, n) for key, n in tokens.items() if n)
+
+    def learn(self, observations):
+        """Return the idle threshold supported by `observations`, or None if there is none yet."""
+        colds = sorted(idle for idle, cold in observations if cold)
+        if len(colds) < self.min_cold:
+            return None
+        for threshold in colds:
+            after = [cold for idle, cold in observations if idle >= threshold]
+            if 2 * sum(after) >= len(after):
+                return threshold
+        return None
+
+    def in_hours(self, now):
+        if self.hours is None:
+            return True
+        start, end = self.hours
+        hour = time.gmtime(now).tm_hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def _roll_day(self, now):
+        day = time.gmtime(now)[:3]
+        if day != self.day:
+            self.day = day
+            self.spent = 0
+
+    def due(self, now, lookahead=0):
+        """Return [((family, model), tokens)] to ping now, cheapest first, within the day's budget.
+
+        A model is due if it would pass `margin` times its threshold within `lookahead`
+        seconds (the time until the caller checks again). Each ping is charged against the
+        budget at the tokens its model's last probe used; see settle().
+        """
+        if self.daily_tokens <= 0 or not self.in_hours(now):
+            return []
+        self._roll_day(now)
+        due = []
+        for key, threshold in self.thresholds.items():
+            last = self.last_seen.get(key)
+            if last is not None and now + lookahead >= last + self.margin * threshold:
+                due.append((self.ping_tokens.get(key, 32), key))
+        pings = []
+        for tokens, key in sorted(due):
+            if self.spent + tokens > self.daily_tokens:
+                break
+            self.spent += tokens
+            self.pings += 1
+            pings.append((key, tokens))
+        return pings
+
+    def settle(self, charged, used):
+        """Correct the budget once pings charged at `charged` tokens actually `used` tokens."""
+        self.spent += used - charged
+
+    def forget(self, family, keep):
+        """Drop the state of models of `family` that are no longer in `keep`."""
+        keep = set(keep)
+        for state in (self.last_seen, self.observations, self.thresholds, self.cold_starts, self.ping_tokens):
+            for key in [k for k in state if k[0] == family and k[1] not in keep]:
+                del state[key]
@@ -1,12 +1,26 @@
 import os
 import sys
 import json
+import gzip
+import math
 import time
+import signal
+import socket
+import selectors
+import hashlib
 import subprocess
 import threading
 import logging
+import urllib.parse
+import concurrent.futures
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
+from keep_warm import KeepWarm, parse_hours
+from probe_planner import ProbePlanner
+from probe_store import ProbeStore
+from sharding import Membership, open_leases
+from ttft_history import TTFTRing, quantiles
+
 # Thread safety lock
 data_lock = threading.Lock()
 
@@ -40,413 +54,1433 @@ handler = logging.StreamHandler(sys.stdout)
 handler.setFormatter(JsonFormatter())
 logger.addHandler(handler)
 
-# Global state
-latest_results = []
-last_run_timestamp = 0.0
-last_error = None
+class RateLimiter:
+    """Token bucket per caller: `burst` requests at once, refilled at `rate` per second."""
 
-suppliers_results = []
-suppliers_last_run_timestamp = 0.0
-suppliers_last_error = None
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # caller -> (tokens, last refill time)
+        self.lock = threading.Lock()
 
-litellm_results = []
-litellm_last_run_timestamp = 0.0
-litellm_last_error = None
+    def allow(self, caller, now):
+        """Take one token for `caller`; returns (allowed, seconds until the next token)."""
+        with self.lock:
+            if len(self.buckets) > 1024:
+                # Full buckets carry no state worth keeping
+                self.buckets = {k: v for k, v in self.buckets.items()
+                                if v[0] + (now - v[1]) * self.rate < self.burst}
+            tokens, last = self.buckets.get(caller, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[caller] = (tokens, now)
+                return False, (1 - tokens) / self.rate
+            self.buckets[caller] = (tokens - 1, now)
+            return True, 0.0
 
-zuplo_results = []
-zuplo_last_run_timestamp = 0.0
-zuplo_last_error = None
+    def refund(self, caller):
+        """Give back the token last taken for `caller`."""
+        with self.lock:
+            if caller in self.buckets:
+                tokens, last = self.buckets[caller]
+                self.buckets[caller] = (min(self.burst, tokens + 1), last)
 
-def run_health_check():
-    global latest_results, last_run_timestamp, last_error
-    global suppliers_results, suppliers_last_run_timestamp, suppliers_last_error
-    global litellm_results, litellm_last_run_timestamp, litellm_last_error
-    global zuplo_results, zuplo_last_run_timestamp, zuplo_last_error
-    
-    logger.info("Running health checks...")
-    
-    # 1. Run Hugging Face Check
-    hf_script = "/app/huggingface.py"
-    if not os.path.exists(hf_script):
-        hf_script = os.path.abspath(os.path.join(os.path.dirname(__file__), "huggingface.py"))
-        
-    try:
-        result = subprocess.run(
-            [sys.executable, hf_script, "-json"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
+# Check families: (metric prefix / status key, script, display name, log check_type)
+FAMILIES = (
+    ("huggingface", "huggingface.py", "HuggingFace", "huggingface"),
+    ("suppliers", "suppliers.py", "Suppliers", "suppliers"),
+    ("litellm_router", "litellm.py", "LiteLLM", "litellm"),
+    ("zuplo", "zuplo.py", "Zuplo", "zuplo"),
+)
+
+FAMILY_BY_PREFIX = {family[0]: family for family in FAMILIES}
+
+# Global state, keyed by family prefix
+family_state = {
+    family: {"results": [], "last_run_timestamp": 0.0, "last_error": None, "last_full_run_timestamp": 0.0}
+    for family, _, _, _ in FAMILIES
+}
+
+# Self-instrumentation of the health-check service; per-family values keyed by family prefix
+service_stats = {
+    "cycle_duration": math.nan,
+    "cycles_total": 0,
+    "run_duration": {family: math.nan for family, _, _, _ in FAMILIES},
+    "runs_total": {family: 0 for family, _, _, _ in FAMILIES},
+    "runs_in_progress": {family: 0 for family, _, _, _ in FAMILIES},
+    "models_in_running_batches": {family: 0 for family, _, _, _ in FAMILIES},
+    "timeouts_total": {family: 0 for family, _, _, _ in FAMILIES},
+    "prompt_tokens_total": {family: 0 for family, _, _, _ in FAMILIES},
+    "completion_tokens_total": {family: 0 for family, _, _, _ in FAMILIES},
+}
+
+# Adaptive probe scheduling: the scheduler wakes every PROBE_TICK_SECONDS and only probes
+# models the planner reports as due; each family still gets a full run (which also picks up
+# new models) every PROBE_FULL_INTERVAL seconds
+PROBE_TICK_SECONDS = int(os.environ.get("PROBE_TICK_SECONDS", 300))
+PROBE_FULL_INTERVAL = int(os.environ.get("PROBE_FULL_INTERVAL", 14400))
+PLANNER_MIN_SAMPLES = 5
+planner = ProbePlanner(
+    base_interval=int(os.environ.get("PROBE_BASE_INTERVAL", 3600)),
+    min_interval=PROBE_TICK_SECONDS,
+    max_interval=PROBE_FULL_INTERVAL,
+)
+
+# Keep-warm: a probe whose TTFT is an outlier after an idle period counts as a cold start, and
+# each model's idle time before a cold start is learned from those (see keep_warm.py). Within
+# KEEP_WARM_HOURS (UTC, e.g. "7-22"; empty: all day) models with a learned threshold get a
+# probe just before they would go cold, for at most KEEP_WARM_DAILY_TOKENS tokens a day
+# (0, the default, only learns and exports the thresholds)
+keep_warm = KeepWarm(
+    cold_factor=float(os.environ.get("KEEP_WARM_COLD_FACTOR", 3.0)),
+    cold_min_seconds=float(os.environ.get("KEEP_WARM_COLD_MIN_SECONDS", 1.0)),
+    daily_tokens=int(os.environ.get("KEEP_WARM_DAILY_TOKENS", 0)),
+    hours=parse_hours(os.environ.get("KEEP_WARM_HOURS", "7-22")),
+)
+
+# Full-stream probes read every chat stream to the end to measure decode speed (TPOT,
+# inter-token latency, tokens/sec); off by default as they generate up to 256 tokens each
+PROBE_FULL_STREAM = os.environ.get("PROBE_FULL_STREAM", "").lower() in ("1", "true", "yes")
+
+# A scheduler cycle (and any other family run) must finish within PROBE_RUN_DEADLINE seconds,
+# so it never spills into the next tick: scripts report probes still unfinished by their
+# deadline as timeouts, and a script that has not exited PROBE_RUN_GRACE seconds later is killed
+PROBE_RUN_DEADLINE = float(os.environ.get("PROBE_RUN_DEADLINE", PROBE_TICK_SECONDS * 0.8))
+PROBE_RUN_GRACE = 15
+
+# Correlated probes: every CORRELATED_PROBE_INTERVAL seconds (0 disables), models reachable
+# through more than one path are probed on all paths at the same time, so the TTFT difference
+# between adjacent paths can be attributed to the gateway hop in between
+CORRELATED_PROBE_INTERVAL = int(os.environ.get("CORRELATED_PROBE_INTERVAL", 3600))
+# Request path from the user towards the supplier: (hop label, outer family, inner family)
+HOPS = (
+    ("huggingface_zuplo", "huggingface", "zuplo"),
+    ("zuplo_litellm", "zuplo", "litellm_router"),
+    ("litellm_suppliers", "litellm_router", "suppliers"),
+)
+hop_overhead = {}  # (hop, model) -> seconds, from the last correlated probe
+correlated_state = {
+    "next_due": time.time() + CORRELATED_PROBE_INTERVAL,
+    "last_run_timestamp": 0.0,
+    "window": math.nan,
+}
+
+# Long-context probes (opt-in): every LONG_CONTEXT_PROBE_INTERVAL seconds (0, the default,
+# disables them) each supplier endpoint gets prompts of LONG_CONTEXT_LENGTHS tokens with
+# LONG_CONTEXT_MAX_TOKENS-token answers, to measure prefill and decode speed at the context
+# sizes users send. A run spends at most LONG_CONTEXT_TOKEN_BUDGET tokens; endpoints beyond
+# it wait for a later run. Runs go in the background, next to the regular ticks, with their
+# own LONG_CONTEXT_DEADLINE: the endpoints of a host are probed one after another at up to
+# LONG_CONTEXT_TIMEOUT seconds per request, so each run only takes as many endpoints per host
+# as fit in the deadline (3 by default) and rotates through the rest over later runs
+LONG_CONTEXT_PROBE_INTERVAL = int(os.environ.get("LONG_CONTEXT_PROBE_INTERVAL", 0))
+LONG_CONTEXT_LENGTHS = os.environ.get("LONG_CONTEXT_LENGTHS", "8192,32768")
+LONG_CONTEXT_MAX_TOKENS = int(os.environ.get("LONG_CONTEXT_MAX_TOKENS", 1024))
+LONG_CONTEXT_TOKEN_BUDGET = int(os.environ.get("LONG_CONTEXT_TOKEN_BUDGET", 500000))
+LONG_CONTEXT_TIMEOUT = float(os.environ.get("LONG_CONTEXT_TIMEOUT", 120))
+LONG_CONTEXT_DEADLINE = float(os.environ.get("LONG_CONTEXT_DEADLINE", 3 * len(LONG_CONTEXT_LENGTHS.split(",")) * LONG_CONTEXT_TIMEOUT))
+long_context_results = {}  # (model, api_base) -> (timestamp, curve), from the last probe of the endpoint
+long_context_state = {
+    "next_due": time.time() + LONG_CONTEXT_PROBE_INTERVAL,
+    "running": False,
+}
+
+# Capability canaries: every CANARY_PROBE_INTERVAL seconds (0 disables) supplier endpoints
+# get a minimal tool-call, image and reasoning request, as far as the catalog says they
+# support them, to check the tool parser, image encoder and reasoning paths respond
+CANARY_PROBE_INTERVAL = int(os.environ.get("CANARY_PROBE_INTERVAL", 3600))
+canary_results = {}  # (model, api_base) -> (timestamp, {capability: {"success", "first", "error"}})
+canary_state = {
+    "next_due": time.time() + CANARY_PROBE_INTERVAL,
+}
+
+# Batch throughput: every BATCH_PROBE_INTERVAL seconds (0 disables) the embedding and rerank
+# models behind LiteLLM and Zuplo are probed with --batch-throughput, which sends batches of
+# BATCH_SIZES passages after a successful probe; other runs leave batches out
+BATCH_PROBE_INTERVAL = int(os.environ.get("BATCH_PROBE_INTERVAL", 3600))
+BATCH_FAMILIES = ("litellm_router", "zuplo")
+batch_results = {}  # (family, model) -> (timestamp, curve), from the last throughput probe of the model
+batch_state = {
+    "next_due": time.time() + BATCH_PROBE_INTERVAL,
+}
+
+# On-demand probes (POST /probe): results younger than PROBE_CACHE_SECONDS are reused,
+# identical concurrent requests share one probe, and only a request that starts a new probe
+# is rate limited. At most PROBE_MAX_IN_FLIGHT probes run at once, on their own executor,
+# and at most PROBE_MAX_WAITING requests (well below HTTP_WORKERS) may wait for one, so
+# on-demand probes can never take all HTTP workers away from scrapes
+PROBE_CACHE_SECONDS = int(os.environ.get("PROBE_CACHE_SECONDS", 60))
+PROBE_MAX_IN_FLIGHT = int(os.environ.get("PROBE_MAX_IN_FLIGHT", 2))
+PROBE_MAX_WAITING = int(os.environ.get("PROBE_MAX_WAITING", 4))
+probe_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_MAX_IN_FLIGHT, thread_name_prefix="probe")
+probe_slots = threading.BoundedSemaphore(PROBE_MAX_IN_FLIGHT)
+probe_waiters = threading.BoundedSemaphore(PROBE_MAX_WAITING)
+probe_lock = threading.Lock()
+probe_cache = {}  # (family, model) -> (results, error, timestamp)
+probe_inflight = {}  # (family, model) -> Future of (results, error, timestamp)
+probe_rate_limiter = RateLimiter(
+    rate=float(os.environ.get("PROBE_RATE_LIMIT_PER_MINUTE", 6)) / 60,
+    burst=int(os.environ.get("PROBE_RATE_LIMIT_BURST", 3)),
+)
+
+# Recent TTFT samples keyed by (family, model, api_base); api_base is "" except for suppliers,
+# whose deployments of one model on different hosts are tracked apart; see record_ttft()
+ttft_history = {}
+TTFT_HISTORY_SIZE = int(os.environ.get("TTFT_HISTORY_SIZE", 256))
+
+# Anomaly detection: each model's TTFT EWMA is scored against the median and MAD of its ring
+# (robust z-score, see TTFTRing.anomaly_score()). A score above ANOMALY_THRESHOLD marks the
+# model degraded until it drops below ANOMALY_CLEAR; a family is degraded likewise on the
+# median score of its models, i.e. when most of its models slowed down together
+ANOMALY_THRESHOLD = float(os.environ.get("ANOMALY_THRESHOLD", 3.5))
+ANOMALY_CLEAR = float(os.environ.get("ANOMALY_CLEAR", 2.0))
+ANOMALY_MIN_SAMPLES = int(os.environ.get("ANOMALY_MIN_SAMPLES", 20))
+ANOMALY_EWMA_ALPHA = float(os.environ.get("ANOMALY_EWMA_ALPHA", 0.3))
+anomalies = {}  # (family, model, api_base) -> {"score", "median", "mad"}, updated with every sample
+degraded = set()  # degraded (family, model, api_base) keys, and (family, None) for whole families
+
+# Last TTFT keyed by (family, model, api_base, connection), connection being "cold" (new
+# connection) or "warm" (pooled keep-alive connection); see record_ttft()
+ttft_by_connection = {}
+
+# Last probe of each LiteLLM deployment, keyed by (family, model, deployment), from the
+# litellm/zuplo responses that name the deployment they were routed to; see record_deployments()
+deployment_state = {}
+DEPLOYMENT_STALE_SECONDS = float(os.environ.get("DEPLOYMENT_STALE_SECONDS", 86400))
+
+# On-disk probe history used for warm restarts and /history; see restore_from_history()
+HISTORY_PATH = os.environ.get("HISTORY_PATH", "/data/probe-history.bin")
+HISTORY_CAPACITY = int(os.environ.get("HISTORY_CAPACITY", 65536))
+# Most records one /history response returns; the response is streamed as they are read
+HISTORY_LIMIT = int(os.environ.get("HISTORY_LIMIT", 5000))
+probe_store = None
+
+# Sharding: with SHARD_LEASE_URL set (redis://host:6379/0, or a directory shared by the
+# replicas) each replica holds a lease, renewed every SHARD_LEASE_TTL / 3 seconds, and only
+# probes, keeps state for and exports the models the hash ring over the replicas with a live
+# lease assigns to it (see sharding.py). Unset, the single replica probes every model
+SHARD_LEASE_URL = os.environ.get("SHARD_LEASE_URL", "")
+SHARD_LEASE_TTL = float(os.environ.get("SHARD_LEASE_TTL", 30))
+REPLICA_ID = os.environ.get("REPLICA_ID") or socket.gethostname()
+membership = None
+shard_state = {"rebalances_total": 0, "lease_errors_total": 0}
+
+# Pre-rendered /metrics payload as (body, gzip_body, etag), rebuilt by publish_metrics()
+metrics_snapshot = (b"", b"", '""')
+# Renders are numbered under data_lock; the snapshot only ever moves to a newer render
+metrics_state = {"rendered": 0, "published": 0}
+snapshot_lock = threading.Lock()
+
+def record_ttft(family, results):
+    """Append successful TTFT samples to the per-model (per-endpoint for suppliers) rings and rescore them.
+    Caller must hold data_lock."""
+    updated = set()
+    for r in results:
+        ttft = r.get("ttft")
+        if not r.get("success", False) or ttft is None:
+            continue
+        key = (family, r.get("model", ""), r.get("api_base", ""))
+        ring = ttft_history.get(key)
+        if ring is None:
+            ring = ttft_history[key] = TTFTRing(TTFT_HISTORY_SIZE, ewma_alpha=ANOMALY_EWMA_ALPHA)
+        ring.add(ttft)
+        updated.add(key)
+        if r.get("connection"):
+            ttft_by_connection[key + (r["connection"],)] = ttft
+    if updated:
+        update_anomalies(family, updated)
+
+def set_degraded(key, score):
+    """Enter the degraded state above ANOMALY_THRESHOLD and leave it below ANOMALY_CLEAR."""
+    if score is not None and score > ANOMALY_THRESHOLD:
+        degraded.add(key)
+    elif score is None or score < ANOMALY_CLEAR:
+        degraded.discard(key)
+
+def update_anomalies(family, keys):
+    """Rescore the rings of `keys`, then the family. Caller must hold data_lock."""
+    for key in keys:
+        ring = ttft_history[key]
+        score = ring.anomaly_score(ANOMALY_MIN_SAMPLES)
+        if score is None:
+            anomalies.pop(key, None)
+        else:
+            median, mad = ring.baseline()
+            anomalies[key] = {"score": score, "median": median, "mad": mad}
+        set_degraded(key, score)
+    scores = [a["score"] for key, a in anomalies.items() if key[0] == family]
+    set_degraded((family, None), quantiles(scores, (0.5,))[0.5] if scores else None)
+
+def record_deployments(family, results, timestamp):
+    """Keep the latest outcome per deployment and drop deployments not seen for
+    DEPLOYMENT_STALE_SECONDS. Caller must hold data_lock."""
+    for r in results:
+        deployment = r.get("deployment")
+        if not deployment:
+            continue
+        key = (family, r.get("model", ""), deployment.get("id") or deployment.get("api_base"))
+        deployment_state[key] = {
+            "api_base": deployment.get("api_base") or "",
+            "success": r.get("success", False),
+            "ttft": r.get("ttft"),
+            "timestamp": timestamp,
+        }
+    for key, state in list(deployment_state.items()):
+        if timestamp - state["timestamp"] > DEPLOYMENT_STALE_SECONDS:
+            del deployment_state[key]
+
+def record_probe_costs(family, results):
+    """Count timeouts and the tokens spent by probes. Caller must hold data_lock."""
+    for r in results:
+        error = (r.get("error") or "").lower()
+        if "timed out" in error or "timeout" in error:
+            service_stats["timeouts_total"][family] += 1
+        usage = r.get("usage") or {}
+        service_stats["prompt_tokens_total"][family] += usage.get("prompt_tokens") or 0
+        service_stats["completion_tokens_total"][family] += usage.get("completion_tokens") or 0
+
+def failed_results(previous, models, error):
+    """Failure results for `models` after a run that returned none: one per endpoint (api_base)
+    the model had in `previous`, or one for the model if it had none."""
+    failed = []
+    for model in models:
+        entries = [r for r in previous if r.get("model", "") == model] or [{}]
+        for r in entries:
+            entry = {"model": model, "success": False, "ttft": None, "error": error}
+            if "api_base" in r:
+                entry["api_base"] = r["api_base"]
+            failed.append(entry)
+    return failed
+
+def merge_results(previous, probed, results):
+    """Replace the entries of the `probed` models in `previous` with fresh `results`."""
+    by_model = {}
+    for r in results:
+        by_model.setdefault(r.get("model", ""), []).append(r)
+    merged = []
+    for r in previous:
+        model = r.get("model", "")
+        if model not in probed:
+            merged.append(r)
+        elif model in by_model:
+            merged.extend(by_model.pop(model))
+    for fresh in by_model.values():
+        merged.extend(fresh)
+    return merged
+
+def ttft_baselines(family):
+    """Median TTFT per (model, api_base) of `family` with enough samples. Caller must hold data_lock."""
+    return {
+        (model, api_base): ring.quantiles((0.5,))[0.5]
+        for (ring_family, model, api_base), ring in ttft_history.items()
+        if ring_family == family and ring.size >= PLANNER_MIN_SAMPLES
+    }
+
+def store_results(family, results, error, models=None):
+    """Publish one family run into the in-memory state, TTFT history, planner and probe store.
+
+    When `models` is given the run only covered those models, and their results are
+    merged into the family's previous results instead of replacing them. With sharding only
+    the models this replica owns are kept: on-demand probes of other models are answered
+    but not stored, and runs that straddle a rebalance drop the models that moved away.
+    """
+    if membership is not None:
+        results = [r for r in results if membership.owns(r.get("model", ""))]
+        if models is not None:
+            models = [model for model in models if membership.owns(model)]
+            if not models:
+                return
+    timestamp = time.time()
+    fresh = results
+    with data_lock:
+        state = family_state[family]
+        if models is None:
+            state["last_full_run_timestamp"] = timestamp
+        else:
+            if not results and error is not None:
+                # The run failed as a whole: the requested models failed, the others keep their results
+                fresh = failed_results(state["results"], models, error)
+            results = merge_results(state["results"], set(models), fresh)
+            failures = [r for r in results if not r.get("success", False)]
+            error = None
+            if failures:
+                err_msgs = [f"{f.get('model')}: {f.get('error')}" for f in failures]
+                error = f"{len(failures)} model(s) failed testing: {', '.join(err_msgs)}"
+        state["results"] = results
+        state["last_run_timestamp"] = timestamp
+        state["last_error"] = error
+        # Cold starts are judged against the median before this run's samples join it
+        keep_warm.observe_run(family, fresh, ttft_baselines(family), timestamp)
+        record_ttft(family, fresh)
+        record_deployments(family, fresh, timestamp)
+        record_probe_costs(family, fresh)
+        for r in fresh:
+            if r.get("batches"):
+                batch_results[(family, r.get("model", ""))] = (timestamp, r["batches"])
+
+        if family == "suppliers" and models is None:
+            weights = {}
+            for r in fresh:
+                model = r.get("model", "")
+                weights[model] = weights.get(model, 0) + (r.get("weight") or 0)
+            planner.set_weights(weights)
+        planner.observe_run(family, fresh, ttft_baselines(family), timestamp)
+        if models is None:
+            planner.forget(family, [r.get("model", "") for r in fresh])
+            keep_warm.forget(family, [r.get("model", "") for r in fresh])
+            listed = {r.get("model", "") for r in fresh}
+            for key in [key for key in batch_results if key[0] == family and key[1] not in listed]:
+                del batch_results[key]
+
+    if probe_store is not None and fresh:
         try:
-            data = json.loads(result.stdout)
-            with data_lock:
-                latest_results = data.get("results", [])
-                last_run_timestamp = time.time()
-                error_obj = data.get("error")
-                if error_obj:
-                    last_error = error_obj.get("message")
-                else:
-                    last_error = None
-            logger.info("HuggingFace health check completed", extra={
-                "check_type": "huggingface",
-                "success": last_error is None,
-                "results": latest_results,
-                "error": last_error
-            })
-        except json.JSONDecodeError:
-            with data_lock:
-                latest_results = []
-                last_run_timestamp = time.time()
-                last_error = f"Invalid JSON output from huggingface.py. Stdout: {result.stdout[:500]} Stderr: {result.stderr[:500]}"
-            logger.error("Failed to decode JSON from huggingface.py", extra={
-                "check_type": "huggingface",
-                "success": False,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "error": last_error
-            })
-    except Exception as e:
+            probe_store.append_run(family, timestamp, fresh)
+        except Exception as e:
+            logger.error(f"Failed to persist {family} results: {e}", exc_info=True)
+    publish_metrics()
+
+def run_family(family, script_name, display_name, check_type, models=None, deadline=PROBE_RUN_DEADLINE, flags=()):
+    """Run one probe script in JSON mode, optionally restricted to `models`, and store its results.
+
+    The script gets `deadline` seconds (0: unbounded) and the extra options `flags`. Returns
+    the run's own (results, error).
+    """
+    with data_lock:
+        expected = len(models) if models is not None else len({r.get("model", "") for r in family_state[family]["results"]})
+        service_stats["runs_in_progress"][family] += 1
+        service_stats["models_in_running_batches"][family] += expected
+    publish_metrics()
+
+    t0 = time.time()
+    try:
+        return run_family_script(family, script_name, display_name, check_type, models, deadline, flags)
+    finally:
         with data_lock:
-            latest_results = []
-            last_run_timestamp = time.time()
-            last_error = f"Exception running huggingface.py: {e}"
-        logger.error(f"Exception running huggingface.py: {e}", exc_info=True, extra={
-            "check_type": "huggingface",
-            "success": False,
-            "error": last_error
-        })
+            service_stats["runs_in_progress"][family] -= 1
+            service_stats["models_in_running_batches"][family] -= expected
+            service_stats["run_duration"][family] = time.time() - t0
+            service_stats["runs_total"][family] += 1
+        publish_metrics()
 
-    # 2. Run Suppliers Check
-    suppliers_script = "/app/suppliers.py"
-    if not os.path.exists(suppliers_script):
-        suppliers_script = os.path.abspath(os.path.join(os.path.dirname(__file__), "suppliers.py"))
-        
+def script_path(script_name):
+    """Return the path of a probe script: /app in the image, next to this file otherwise."""
+    script = f"/app/{script_name}"
+    if not os.path.exists(script):
+        script = os.path.abspath(os.path.join(os.path.dirname(__file__), script_name))
+    return script
+
+def shard_args():
+    """Script options that restrict a run to this replica's shard (none without sharding)."""
+    if membership is None:
+        return []
+    return ["--shard", REPLICA_ID, "--shard-members", ",".join(membership.ring.members)]
+
+def run_family_script(family, script_name, display_name, check_type, models=None, deadline=PROBE_RUN_DEADLINE, flags=()):
+    cmd = [sys.executable, script_path(script_name), "-json", *flags]
+    if models is not None:
+        cmd += ["--models", ",".join(models)]
+    else:
+        cmd += shard_args()
+    if PROBE_FULL_STREAM:
+        cmd.append("--full-stream")
+    if deadline > 0:
+        cmd += ["--deadline", f"{deadline:.3f}"]
     try:
         result = subprocess.run(
-            [sys.executable, suppliers_script, "-json"],
+            cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True
+            text=True,
+            timeout=deadline + PROBE_RUN_GRACE if deadline > 0 else None
         )
         try:
             data = json.loads(result.stdout)
-            with data_lock:
-                suppliers_results = data.get("results", [])
-                suppliers_last_run_timestamp = time.time()
-                error_obj = data.get("error")
-                if error_obj:
-                    suppliers_last_error = error_obj.get("message")
-                else:
-                    suppliers_last_error = None
-            logger.info("Suppliers health check completed", extra={
-                "check_type": "suppliers",
-                "success": suppliers_last_error is None,
-                "results": suppliers_results,
-                "error": suppliers_last_error
+            results = data.get("results", [])
+            error_obj = data.get("error")
+            error = error_obj.get("message") if error_obj else None
+            store_results(family, results, error, models)
+            logger.info(f"{display_name} health check completed", extra={
+                "check_type": check_type,
+                "success": error is None,
+                "results": results,
+                "error": error
             })
+            return results, error
         except json.JSONDecodeError:
-            with data_lock:
-                suppliers_results = []
-                suppliers_last_run_timestamp = time.time()
-                suppliers_last_error = f"Invalid JSON output from suppliers.py. Stdout: {result.stdout[:500]} Stderr: {result.stderr[:500]}"
-            logger.error("Failed to decode JSON from suppliers.py", extra={
-                "check_type": "suppliers",
+            error = f"Invalid JSON output from {script_name}. Stdout: {result.stdout[:500]} Stderr: {result.stderr[:500]}"
+            store_results(family, [], error, models)
+            logger.error(f"Failed to decode JSON from {script_name}", extra={
+                "check_type": check_type,
                 "success": False,
                 "stdout": result.stdout,
                 "stderr": result.stderr,
-                "error": suppliers_last_error
+                "error": error
             })
-    except Exception as e:
+            return [], error
+    except subprocess.TimeoutExpired:
+        error = f"timeout: {script_name} did not finish within its {deadline:.0f}s run deadline and was killed"
         with data_lock:
-            suppliers_results = []
-            suppliers_last_run_timestamp = time.time()
-            suppliers_last_error = f"Exception running suppliers.py: {e}"
-        logger.error(f"Exception running suppliers.py: {e}", exc_info=True, extra={
-            "check_type": "suppliers",
+            expected = models if models is not None else sorted({r.get("model", "") for r in family_state[family]["results"]})
+        results = [{"model": model, "success": False, "ttft": None, "error": error} for model in expected]
+        store_results(family, results, error, models)
+        logger.error(error, extra={
+            "check_type": check_type,
+            "success": False,
+            "error": error
+        })
+        return results, error
+    except Exception as e:
+        error = f"Exception running {script_name}: {e}"
+        store_results(family, [], error, models)
+        logger.error(f"Exception running {script_name}: {e}", exc_info=True, extra={
+            "check_type": check_type,
             "success": False,
-            "error": suppliers_last_error
+            "error": error
         })
+        return [], error
 
-    # 3. Run LiteLLM Check
-    litellm_script = "/app/litellm.py"
-    if not os.path.exists(litellm_script):
-        litellm_script = os.path.abspath(os.path.join(os.path.dirname(__file__), "litellm.py"))
-        
+def run_health_check():
+    """Run one scheduler tick: a full run for families that are due one, due models otherwise."""
+    logger.info("Running health checks...")
+    now = time.time()
+    # Families run one after another and share the cycle's deadline; rotating the order keeps a
+    # slow family from starving the ones after it
+    with data_lock:
+        first = service_stats["cycles_total"] % len(FAMILIES)
+    for family in FAMILIES[first:] + FAMILIES[:first]:
+        prefix = family[0]
+        remaining = now + PROBE_RUN_DEADLINE - time.time() if PROBE_RUN_DEADLINE > 0 else 0
+        if PROBE_RUN_DEADLINE > 0 and remaining < 1:
+            logger.warning(f"Cycle deadline reached; skipping {prefix} until the next cycle", extra={
+                "check_type": family[3]
+            })
+            continue
+        with data_lock:
+            state = family_state[prefix]
+            known = sorted({r.get("model", "") for r in state["results"]})
+            full_run_due = not known or now - state["last_full_run_timestamp"] >= PROBE_FULL_INTERVAL
+            due = None if full_run_due else planner.due(prefix, known, now)
+        if due is None:
+            run_family(*family, deadline=remaining)
+        elif due:
+            logger.info(f"Probing {len(due)} of {len(known)} {prefix} models due for a check", extra={
+                "check_type": family[3],
+                "models": due
+            })
+            run_family(*family, models=due, deadline=remaining)
+    with data_lock:
+        service_stats["cycle_duration"] = time.time() - now
+        service_stats["cycles_total"] += 1
+    publish_metrics()
+
+def path_ttfts(results):
+    """Map lowercased model name -> (model, TTFT) over the successful results of one run.
+
+    Models with several deployments (suppliers) get the mean TTFT weighted by routing
+    weight, which is what LiteLLM's weighted routing sees on average.
+    """
+    sums = {}
+    for r in results:
+        if not r.get("success", False) or r.get("ttft") is None:
+            continue
+        model = r.get("model", "")
+        weight = r.get("weight") or 1
+        _, total, weights = sums.get(model.lower(), (model, 0.0, 0))
+        sums[model.lower()] = (model, total + weight * r["ttft"], weights + weight)
+    return {key: (model, total / weights) for key, (model, total, weights) in sums.items()}
+
+def run_correlated_probes():
+    """Probe every model known to several families on all of them at once and record hop overheads."""
+    with data_lock:
+        names = {
+            prefix: {r.get("model", "").lower(): r.get("model", "") for r in state["results"]}
+            for prefix, state in family_state.items()
+        }
+    counts = {}
+    for family_names in names.values():
+        for key in family_names:
+            counts[key] = counts.get(key, 0) + 1
+    shared = {key for key, count in counts.items() if count > 1}
+    jobs = {prefix: sorted(family_names[key] for key in shared if key in family_names) for prefix, family_names in names.items()}
+    jobs = {prefix: models for prefix, models in jobs.items() if models}
+    if not jobs:
+        return
+
+    logger.info(f"Running correlated probes of {len(shared)} models across {len(jobs)} paths", extra={
+        "check_type": "correlated",
+        "models": sorted(shared)
+    })
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = {prefix: executor.submit(run_family, *FAMILY_BY_PREFIX[prefix], models=models) for prefix, models in jobs.items()}
+    window = time.time() - start
+    ttfts = {prefix: path_ttfts(future.result()[0]) for prefix, future in futures.items()}
+
+    overheads = {}
+    for hop, outer, inner in HOPS:
+        inner_ttfts = ttfts.get(inner, {})
+        for key, (_, outer_ttft) in ttfts.get(outer, {}).items():
+            if key in inner_ttfts:
+                model, inner_ttft = inner_ttfts[key]
+                overheads[(hop, model)] = outer_ttft - inner_ttft
+    with data_lock:
+        hop_overhead.clear()
+        hop_overhead.update(overheads)
+        correlated_state["last_run_timestamp"] = start
+        correlated_state["window"] = window
+    publish_metrics()
+
+def run_suppliers_tier(check_type, *flags, deadline=PROBE_RUN_DEADLINE):
+    """Run suppliers.py in one of its special modes (e.g. --long-context) within `deadline`
+    seconds (0: unbounded); returns its (results, error), or None if it produced no JSON."""
+    cmd = [sys.executable, script_path("suppliers.py"), "-json", *flags, *shard_args()]
+    if deadline > 0:
+        cmd += ["--deadline", f"{deadline:.3f}"]
     try:
         result = subprocess.run(
-            [sys.executable, litellm_script, "-json"],
+            cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True
+            text=True,
+            timeout=deadline + PROBE_RUN_GRACE if deadline > 0 else None
         )
-        try:
-            data = json.loads(result.stdout)
-            with data_lock:
-                litellm_results = data.get("results", [])
-                litellm_last_run_timestamp = time.time()
-                error_obj = data.get("error")
-                if error_obj:
-                    litellm_last_error = error_obj.get("message")
-                else:
-                    litellm_last_error = None
-            logger.info("LiteLLM health check completed", extra={
-                "check_type": "litellm",
-                "success": litellm_last_error is None,
-                "results": litellm_results,
-                "error": litellm_last_error
-            })
-        except json.JSONDecodeError:
-            with data_lock:
-                litellm_results = []
-                litellm_last_run_timestamp = time.time()
-                litellm_last_error = f"Invalid JSON output from litellm.py. Stdout: {result.stdout[:500]} Stderr: {result.stderr[:500]}"
-            logger.error("Failed to decode JSON from litellm.py", extra={
-                "check_type": "litellm",
-                "success": False,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "error": litellm_last_error
-            })
+        data = json.loads(result.stdout)
     except Exception as e:
-        with data_lock:
-            litellm_results = []
-            litellm_last_run_timestamp = time.time()
-            litellm_last_error = f"Exception running litellm.py: {e}"
-        logger.error(f"Exception running litellm.py: {e}", exc_info=True, extra={
-            "check_type": "litellm",
+        logger.error(f"{check_type} probes failed: {e}", extra={
+            "check_type": check_type,
             "success": False,
-            "error": litellm_last_error
+            "error": str(e)
         })
+        return None
+    results = data.get("results", [])
+    error = (data.get("error") or {}).get("message")
+    logger.info(f"{check_type} probes completed", extra={
+        "check_type": check_type,
+        "success": error is None,
+        "results": results,
+        "error": error
+    })
+    with data_lock:
+        record_probe_costs("suppliers", results)
+    return results, error
 
-    # 4. Run Zuplo Check
-    zuplo_script = "/app/zuplo.py"
-    if not os.path.exists(zuplo_script):
-        zuplo_script = os.path.abspath(os.path.join(os.path.dirname(__file__), "zuplo.py"))
-        
+def run_long_context_probes():
+    """Run the long-context tier of suppliers.py and keep each endpoint's prefill/decode curve."""
     try:
-        result = subprocess.run(
-            [sys.executable, zuplo_script, "-json"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+        outcome = run_suppliers_tier(
+            "long_context", "--long-context",
+            "--context-lengths", LONG_CONTEXT_LENGTHS,
+            "--long-max-tokens", str(LONG_CONTEXT_MAX_TOKENS),
+            "--long-timeout", str(LONG_CONTEXT_TIMEOUT),
+            "--token-budget", str(LONG_CONTEXT_TOKEN_BUDGET),
+            deadline=LONG_CONTEXT_DEADLINE,
         )
-        try:
-            data = json.loads(result.stdout)
-            with data_lock:
-                zuplo_results = data.get("results", [])
-                zuplo_last_run_timestamp = time.time()
-                error_obj = data.get("error")
-                if error_obj:
-                    zuplo_last_error = error_obj.get("message")
-                else:
-                    zuplo_last_error = None
-            logger.info("Zuplo health check completed", extra={
-                "check_type": "zuplo",
-                "success": zuplo_last_error is None,
-                "results": zuplo_results,
-                "error": zuplo_last_error
-            })
-        except json.JSONDecodeError:
-            with data_lock:
-                zuplo_results = []
-                zuplo_last_run_timestamp = time.time()
-                zuplo_last_error = f"Invalid JSON output from zuplo.py. Stdout: {result.stdout[:500]} Stderr: {result.stderr[:500]}"
-            logger.error("Failed to decode JSON from zuplo.py", extra={
-                "check_type": "zuplo",
-                "success": False,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "error": zuplo_last_error
-            })
+    finally:
+        long_context_state["running"] = False
+    if outcome is None:
+        return
+    timestamp = time.time()
+    with data_lock:
+        for r in outcome[0]:
+            if r.get("long_context"):
+                long_context_results[(r.get("model", ""), r.get("api_base", ""))] = (timestamp, r["long_context"])
+        for key, (probed, _) in list(long_context_results.items()):
+            # Endpoints gone from the catalog stop being probed; forget them after a week of runs
+            if timestamp - probed > 7 * LONG_CONTEXT_PROBE_INTERVAL:
+                del long_context_results[key]
+    publish_metrics()
+
+def run_canary_probes():
+    """Send the capability canaries through suppliers.py and keep the outcome per endpoint."""
+    outcome = run_suppliers_tier("canary", "--canaries")
+    if outcome is None:
+        return
+    timestamp = time.time()
+    with data_lock:
+        # Every endpoint with a capability is covered by each run, so the last run is the whole state
+        canary_results.clear()
+        for r in outcome[0]:
+            canary_results[(r.get("model", ""), r.get("api_base", ""))] = (timestamp, r.get("canaries") or {})
+    publish_metrics()
+
+def run_batch_probes():
+    """Probe the embedding and rerank models with --batch-throughput to refresh their batch curves."""
+    for family in BATCH_FAMILIES:
+        with data_lock:
+            models = sorted({r.get("model", "") for r in family_state[family]["results"]
+                             if "embed" in r.get("model", "").lower() or "rerank" in r.get("model", "").lower()})
+        if models:
+            run_family(*FAMILY_BY_PREFIX[family], models=models, flags=("--batch-throughput",))
+
+def run_keep_warm_pings():
+    """Probe the models that would otherwise go cold before the next tick, within the token budget."""
+    with data_lock:
+        pings = keep_warm.due(time.time(), lookahead=PROBE_TICK_SECONDS)
+    if not pings:
+        return
+    by_family = {}
+    for (family, model), _ in pings:
+        by_family.setdefault(family, []).append(model)
+    logger.info(f"Sending keep-warm probes to {len(pings)} models", extra={
+        "check_type": "keep_warm",
+        "models": {family: models for family, models in by_family.items()}
+    })
+    used = 0
+    for family, models in by_family.items():
+        results, _ = run_family(*FAMILY_BY_PREFIX[family], models=models)
+        for r in results:
+            usage = r.get("usage") or {}
+            used += (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+    with data_lock:
+        keep_warm.settle(sum(tokens for _, tokens in pings), used)
+    publish_metrics()
+
+def restore_from_history():
+    """Reload the last run of each family and the TTFT rings from the probe store."""
+    with data_lock:
+        for family, (timestamp, results) in probe_store.last_runs(window=PROBE_FULL_INTERVAL).items():
+            state = family_state.get(family)
+            if state is None:
+                continue
+            failures = [r for r in results if not r["success"]]
+            state["results"] = results
+            state["last_run_timestamp"] = timestamp
+            state["last_error"] = f"{len(failures)} model(s) failed testing (restored from history)" if failures else None
+        # One record_ttft() per family, so each model and family is scored once, not per record
+        samples = {}
+        for rec in probe_store.query():
+            if rec["family"] in family_state:
+                samples.setdefault(rec["family"], []).append(rec)
+        for family, records in samples.items():
+            record_ttft(family, records)
+    publish_metrics()
+
+def rebalance():
+    """Drop the state of models now owned by another replica and schedule a full run of every
+    family, which picks up the models that moved to this one."""
+    members = membership.ring.members
+    logger.info(f"Shard members changed; {REPLICA_ID} is one of {len(members)} replicas", extra={
+        "check_type": "shard",
+        "members": list(members)
+    })
+    owns = membership.owns
+    with data_lock:
+        shard_state["rebalances_total"] += 1
+        for table, index in ((ttft_history, 1), (anomalies, 1), (ttft_by_connection, 1), (deployment_state, 1),
+                             (hop_overhead, 1), (long_context_results, 0), (canary_results, 0), (batch_results, 1)):
+            for key in [key for key in table if not owns(key[index])]:
+                del table[key]
+        degraded.difference_update([key for key in degraded if key[1] is not None and not owns(key[1])])
+        for prefix, state in family_state.items():
+            state["results"] = [r for r in state["results"] if owns(r.get("model", ""))]
+            state["last_full_run_timestamp"] = 0.0
+            keep = [r.get("model", "") for r in state["results"]]
+            planner.forget(prefix, keep)
+            keep_warm.forget(prefix, keep)
+            update_anomalies(prefix, ())
+    publish_metrics()
+
+def renew_lease():
+    """Renew this replica's lease and rebalance if the replicas changed.
+
+    If the lease store cannot be reached the last ring is kept, so replicas overlap rather
+    than leave models unprobed until it is back.
+    """
+    try:
+        changed = membership.renew(time.time())
     except Exception as e:
         with data_lock:
-            zuplo_results = []
-            zuplo_last_run_timestamp = time.time()
-            zuplo_last_error = f"Exception running zuplo.py: {e}"
-        logger.error(f"Exception running zuplo.py: {e}", exc_info=True, extra={
-            "check_type": "zuplo",
-            "success": False,
-            "error": zuplo_last_error
+            shard_state["lease_errors_total"] += 1
+        logger.error(f"Could not renew the shard lease of {REPLICA_ID}: {e}", extra={
+            "check_type": "shard",
+            "error": str(e)
         })
+        return
+    if changed:
+        rebalance()
+
+def lease_loop():
+    while True:
+        time.sleep(SHARD_LEASE_TTL / 3)
+        renew_lease()
+
+def series_labels(family, model, api_base=""):
+    """Label set of a model's series: the model, plus its api_base for suppliers, whose models
+    can have several deployments that would otherwise produce duplicate series."""
+    labels = f'model="{model}"'
+    if family == "suppliers":
+        labels += f',api_base="{api_base}"'
+    return labels
+
+def result_labels(family, r):
+    """Label set of one result; see series_labels()."""
+    return series_labels(family, r.get("model", ""), r.get("api_base", ""))
+
+def render_metrics():
+    """Render the Prometheus exposition for every check family. Caller must hold data_lock."""
+    lines = []
+    for prefix, _, _, _ in FAMILIES:
+        state = family_state[prefix]
+        results = state["results"]
+        run_timestamp = state["last_run_timestamp"]
+        error = state["last_error"]
+        lines.append(f"# HELP {prefix}_last_run_timestamp_seconds Unix timestamp of the last health check run")
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_last_run_timestamp_seconds {run_timestamp}")
+
+        global_success = 1 if error is None else 0
+        lines.append(f"# HELP {prefix}_test_global_success Overall status of the health checks (1 = success, 0 = failure)")
+        lines.append(f"# TYPE {prefix}_test_global_success gauge")
+        lines.append(f"{prefix}_test_global_success {global_success}")
+
+        lines.append(f"# HELP {prefix}_model_test_success Success status of individual model test (1 = success, 0 = failure)")
+        lines.append(f"# TYPE {prefix}_model_test_success gauge")
+        for r in results:
+            model = r.get("model", "")
+            success_val = 1 if r.get("success", False) else 0
+            lines.append(f'{prefix}_model_test_success{{model="{model}"}} {success_val}')
+
+        lines.append(f"# HELP {prefix}_model_ttft_seconds Time to First Token (TTFT) in seconds for model")
+        lines.append(f"# TYPE {prefix}_model_ttft_seconds gauge")
+        for r in results:
+            model = r.get("model", "")
+            ttft = r.get("ttft")
+            if ttft is not None:
+                lines.append(f'{prefix}_model_ttft_seconds{{model="{model}"}} {ttft}')
+            else:
+                lines.append(f'{prefix}_model_ttft_seconds{{model="{model}"}} NaN')
+
+        lines.append(f"# HELP {prefix}_model_ttft_by_connection_seconds Last TTFT in seconds for model on a new (cold) or reused keep-alive (warm) connection (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_ttft_by_connection_seconds gauge")
+        for (family, model, api_base, connection), ttft in sorted(ttft_by_connection.items()):
+            if family == prefix:
+                lines.append(f'{prefix}_model_ttft_by_connection_seconds{{{series_labels(prefix, model, api_base)},connection="{connection}"}} {ttft}')
+
+        deployments = sorted((key[1:], state) for key, state in deployment_state.items() if key[0] == prefix)
+        lines.append(f"# HELP {prefix}_deployment_test_success Success status of the last probe routed to deployment of model (1 = success, 0 = failure)")
+        lines.append(f"# TYPE {prefix}_deployment_test_success gauge")
+        for (model, deployment), state in deployments:
+            lines.append(f'{prefix}_deployment_test_success{{model="{model}",deployment="{deployment}",api_base="{state["api_base"]}"}} {1 if state["success"] else 0}')
+
+        lines.append(f"# HELP {prefix}_deployment_ttft_seconds TTFT in seconds of the last probe routed to deployment of model")
+        lines.append(f"# TYPE {prefix}_deployment_ttft_seconds gauge")
+        for (model, deployment), state in deployments:
+            ttft = state["ttft"]
+            lines.append(f'{prefix}_deployment_ttft_seconds{{model="{model}",deployment="{deployment}",api_base="{state["api_base"]}"}} {ttft if ttft is not None else "NaN"}')
+
+        lines.append(f"# HELP {prefix}_deployment_last_probe_timestamp_seconds Unix timestamp of the last probe routed to deployment of model")
+        lines.append(f"# TYPE {prefix}_deployment_last_probe_timestamp_seconds gauge")
+        for (model, deployment), state in deployments:
+            lines.append(f'{prefix}_deployment_last_probe_timestamp_seconds{{model="{model}",deployment="{deployment}",api_base="{state["api_base"]}"}} {state["timestamp"]}')
+
+        lines.append(f"# HELP {prefix}_model_cold_start Whether the last probe of model was classified as a cold start (TTFT outlier after idling; 1 = cold start) (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_cold_start gauge")
+        for r in results:
+            if "cold_start" in r:
+                lines.append(f'{prefix}_model_cold_start{{{result_labels(prefix, r)}}} {1 if r["cold_start"] else 0}')
+
+        lines.append(f"# HELP {prefix}_model_cold_starts_total Number of probes of model classified as cold starts")
+        lines.append(f"# TYPE {prefix}_model_cold_starts_total counter")
+        for (family, model), count in sorted(keep_warm.cold_starts.items()):
+            if family == prefix:
+                lines.append(f'{prefix}_model_cold_starts_total{{model="{model}"}} {count}')
+
+        lines.append(f"# HELP {prefix}_model_cold_start_threshold_seconds Learned idle time in seconds after which a request to model is likely to be a cold start")
+        lines.append(f"# TYPE {prefix}_model_cold_start_threshold_seconds gauge")
+        for (family, model), threshold in sorted(keep_warm.thresholds.items()):
+            if family == prefix:
+                lines.append(f'{prefix}_model_cold_start_threshold_seconds{{model="{model}"}} {threshold}')
+
+        lines.append(f"# HELP {prefix}_model_phase_seconds Time in seconds spent in each request phase (dns, connect, tls, ttfb, first_token) of the last probe for model (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_phase_seconds gauge")
+        for r in results:
+            labels = result_labels(prefix, r)
+            for phase, seconds in (r.get("phases") or {}).items():
+                lines.append(f'{prefix}_model_phase_seconds{{{labels},phase="{phase}"}} {seconds}')
+
+        streams = [(result_labels(prefix, r), r["stream"]) for r in results if r.get("stream")]
+        lines.append(f"# HELP {prefix}_model_total_latency_seconds Total latency in seconds of the last full-stream probe for model (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_total_latency_seconds gauge")
+        for labels, stream in streams:
+            lines.append(f'{prefix}_model_total_latency_seconds{{{labels}}} {stream["total_latency"]}')
+
+        lines.append(f"# HELP {prefix}_model_tpot_seconds Time per output token in seconds after the first token, from the last full-stream probe for model (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_tpot_seconds gauge")
+        for labels, stream in streams:
+            tpot = stream.get("tpot")
+            lines.append(f'{prefix}_model_tpot_seconds{{{labels}}} {tpot if tpot is not None else "NaN"}')
+
+        lines.append(f"# HELP {prefix}_model_itl_seconds Inter-token latency quantiles in seconds between streamed chunks of the last full-stream probe for model (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_itl_seconds gauge")
+        for labels, stream in streams:
+            for q, value in (stream.get("itl") or {}).items():
+                lines.append(f'{prefix}_model_itl_seconds{{{labels},quantile="{q}"}} {value}')
+
+        lines.append(f"# HELP {prefix}_model_output_tokens_per_second Output tokens per second over the whole last full-stream probe for model (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_output_tokens_per_second gauge")
+        for labels, stream in streams:
+            rate = stream.get("tokens_per_second")
+            lines.append(f'{prefix}_model_output_tokens_per_second{{{labels}}} {rate if rate is not None else "NaN"}')
+
+        batches = [(model, batch) for (family, model), (_, curve) in sorted(batch_results.items()) if family == prefix for batch in curve]
+        lines.append(f"# HELP {prefix}_model_batch_latency_seconds Latency in seconds of one embedding/rerank request of batch_size items, from the last throughput probe for model")
+        lines.append(f"# TYPE {prefix}_model_batch_latency_seconds gauge")
+        for model, batch in batches:
+            lines.append(f'{prefix}_model_batch_latency_seconds{{model="{model}",batch_size="{batch["batch_size"]}"}} {batch["latency"]}')
+
+        lines.append(f"# HELP {prefix}_model_batch_items_per_second Embedding/rerank items processed per second at batch_size, from the last throughput probe for model")
+        lines.append(f"# TYPE {prefix}_model_batch_items_per_second gauge")
+        for model, batch in batches:
+            lines.append(f'{prefix}_model_batch_items_per_second{{model="{model}",batch_size="{batch["batch_size"]}"}} {batch["items_per_second"]}')
+
+        rings = sorted((series_labels(prefix, model, api_base), ring) for (family, model, api_base), ring in ttft_history.items() if family == prefix)
+        lines.append(f"# HELP {prefix}_model_ttft_histogram_seconds Distribution of Time to First Token (TTFT) in seconds for model (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_ttft_histogram_seconds histogram")
+        for labels, ring in rings:
+            for bound, count in zip(ring.buckets, ring.bucket_counts):
+                lines.append(f'{prefix}_model_ttft_histogram_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{prefix}_model_ttft_histogram_seconds_bucket{{{labels},le="+Inf"}} {ring.count}')
+            lines.append(f'{prefix}_model_ttft_histogram_seconds_sum{{{labels}}} {ring.sum}')
+            lines.append(f'{prefix}_model_ttft_histogram_seconds_count{{{labels}}} {ring.count}')
+
+        scored = sorted((series_labels(prefix, key[1], key[2]), key, a) for key, a in anomalies.items() if key[0] == prefix)
+        lines.append(f"# HELP {prefix}_model_ttft_ewma_seconds Exponentially weighted moving average of TTFT in seconds for model (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_ttft_ewma_seconds gauge")
+        for labels, ring in rings:
+            lines.append(f'{prefix}_model_ttft_ewma_seconds{{{labels}}} {ring.ewma}')
+
+        lines.append(f"# HELP {prefix}_model_ttft_baseline_seconds Median TTFT in seconds over the most recent samples for model, the anomaly baseline (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_ttft_baseline_seconds gauge")
+        for labels, _, a in scored:
+            lines.append(f'{prefix}_model_ttft_baseline_seconds{{{labels}}} {a["median"]}')
+
+        lines.append(f"# HELP {prefix}_model_ttft_mad_seconds Median absolute deviation of TTFT in seconds over the most recent samples for model (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_ttft_mad_seconds gauge")
+        for labels, _, a in scored:
+            lines.append(f'{prefix}_model_ttft_mad_seconds{{{labels}}} {a["mad"]}')
+
+        lines.append(f"# HELP {prefix}_model_anomaly_score Robust z-score of the TTFT EWMA against the baseline for model (MAD-scaled deviations above the median; per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_anomaly_score gauge")
+        for labels, _, a in scored:
+            lines.append(f'{prefix}_model_anomaly_score{{{labels}}} {a["score"]}')
+
+        lines.append(f"# HELP {prefix}_model_degraded Whether model is degraded: anomaly score above {ANOMALY_THRESHOLD:g}, until it drops below {ANOMALY_CLEAR:g} (1 = degraded; per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_degraded gauge")
+        for labels, key, _ in scored:
+            lines.append(f'{prefix}_model_degraded{{{labels}}} {1 if key in degraded else 0}')
+
+        scores = [a["score"] for _, _, a in scored]
+        lines.append(f"# HELP {prefix}_anomaly_score Median anomaly score over the models of the family")
+        lines.append(f"# TYPE {prefix}_anomaly_score gauge")
+        lines.append(f"{prefix}_anomaly_score {quantiles(scores, (0.5,))[0.5] if scores else 'NaN'}")
+        lines.append(f"# HELP {prefix}_degraded Whether the family as a whole is degraded, by its median anomaly score (1 = degraded)")
+        lines.append(f"# TYPE {prefix}_degraded gauge")
+        lines.append(f"{prefix}_degraded {1 if (prefix, None) in degraded else 0}")
+
+        lines.append(f"# HELP {prefix}_model_ttft_quantile_seconds TTFT quantiles in seconds over the most recent samples for model (per api_base for suppliers)")
+        lines.append(f"# TYPE {prefix}_model_ttft_quantile_seconds gauge")
+        for labels, ring in rings:
+            for q, value in ring.quantiles().items():
+                lines.append(f'{prefix}_model_ttft_quantile_seconds{{{labels},quantile="{q}"}} {value}')
+
+    long_context = sorted(long_context_results.items())
+    long_context_metrics = (
+        ("model_long_context_ttft_seconds", "TTFT in seconds of a long-context probe with a prompt of context_tokens tokens", "ttft"),
+        ("model_prefill_tokens_per_second", "Prompt tokens prefilled per second (prompt tokens over the time to first token) with a prompt of context_tokens tokens", "prefill_tokens_per_second"),
+        ("model_decode_tokens_per_second", "Output tokens decoded per second (1 / TPOT) after a prompt of context_tokens tokens", "decode_tokens_per_second"),
+    )
+    for name, help_text, field in long_context_metrics:
+        lines.append(f"# HELP suppliers_{name} {help_text}, from the last long-context probe of the endpoint")
+        lines.append(f"# TYPE suppliers_{name} gauge")
+        for (model, api_base), (_, curve) in long_context:
+            for point in curve:
+                value = point.get(field)
+                lines.append(f'suppliers_{name}{{model="{model}",api_base="{api_base}",context_tokens="{point["context_tokens"]}"}} {value if value is not None else "NaN"}')
+    lines.append("# HELP suppliers_long_context_probe_timestamp_seconds Unix timestamp of the last long-context probe of the endpoint")
+    lines.append("# TYPE suppliers_long_context_probe_timestamp_seconds gauge")
+    for (model, api_base), (timestamp, _) in long_context:
+        lines.append(f'suppliers_long_context_probe_timestamp_seconds{{model="{model}",api_base="{api_base}"}} {timestamp}')
+
+    canaries = sorted(canary_results.items())
+    lines.append("# HELP suppliers_model_capability_success Whether the last canary of capability (tools, vision, reasoning) got a well-formed response (1 = success, 0 = failure)")
+    lines.append("# TYPE suppliers_model_capability_success gauge")
+    for (model, api_base), (_, results) in canaries:
+        for capability, canary in sorted(results.items()):
+            lines.append(f'suppliers_model_capability_success{{model="{model}",api_base="{api_base}",capability="{capability}"}} {1 if canary.get("success") else 0}')
+    lines.append("# HELP suppliers_model_capability_latency_seconds Seconds from sending the last canary of capability to its first delta of each kind (tool_call, content, reasoning)")
+    lines.append("# TYPE suppliers_model_capability_latency_seconds gauge")
+    for (model, api_base), (_, results) in canaries:
+        for capability, canary in sorted(results.items()):
+            for delta, seconds in sorted((canary.get("first") or {}).items()):
+                lines.append(f'suppliers_model_capability_latency_seconds{{model="{model}",api_base="{api_base}",capability="{capability}",delta="{delta}"}} {seconds}')
+    lines.append("# HELP suppliers_capability_probe_timestamp_seconds Unix timestamp of the last capability canaries of the endpoint")
+    lines.append("# TYPE suppliers_capability_probe_timestamp_seconds gauge")
+    for (model, api_base), (timestamp, _) in canaries:
+        lines.append(f'suppliers_capability_probe_timestamp_seconds{{model="{model}",api_base="{api_base}"}} {timestamp}')
+
+    lines.append("# HELP gateway_hop_overhead_seconds TTFT added by a gateway hop (outer path minus inner path) for model, from the last correlated probe")
+    lines.append("# TYPE gateway_hop_overhead_seconds gauge")
+    for (hop, model), seconds in sorted(hop_overhead.items()):
+        lines.append(f'gateway_hop_overhead_seconds{{hop="{hop}",model="{model}"}} {seconds}')
+    lines.append("# HELP gateway_correlated_probe_timestamp_seconds Unix timestamp of the last correlated probe")
+    lines.append("# TYPE gateway_correlated_probe_timestamp_seconds gauge")
+    lines.append(f"gateway_correlated_probe_timestamp_seconds {correlated_state['last_run_timestamp']}")
+    lines.append("# HELP gateway_correlated_probe_window_seconds Wall-clock time in which the last correlated probe ran on every path")
+    lines.append("# TYPE gateway_correlated_probe_window_seconds gauge")
+    lines.append(f"gateway_correlated_probe_window_seconds {correlated_state['window']}")
+
+    lines.append("# HELP health_check_cycle_duration_seconds Wall-clock duration of the last scheduler cycle")
+    lines.append("# TYPE health_check_cycle_duration_seconds gauge")
+    lines.append(f"health_check_cycle_duration_seconds {service_stats['cycle_duration']}")
+    lines.append("# HELP health_check_cycles_total Number of completed scheduler cycles")
+    lines.append("# TYPE health_check_cycles_total counter")
+    lines.append(f"health_check_cycles_total {service_stats['cycles_total']}")
+
+    lines.append("# HELP health_check_keep_warm_pings_total Number of keep-warm probes sent")
+    lines.append("# TYPE health_check_keep_warm_pings_total counter")
+    lines.append(f"health_check_keep_warm_pings_total {keep_warm.pings}")
+    lines.append("# HELP health_check_keep_warm_tokens_spent Tokens spent on keep-warm probes today (UTC)")
+    lines.append("# TYPE health_check_keep_warm_tokens_spent gauge")
+    lines.append(f"health_check_keep_warm_tokens_spent {keep_warm.spent}")
+    lines.append("# HELP health_check_keep_warm_daily_token_budget Daily token budget of keep-warm probes (0 = disabled)")
+    lines.append("# TYPE health_check_keep_warm_daily_token_budget gauge")
+    lines.append(f"health_check_keep_warm_daily_token_budget {keep_warm.daily_tokens}")
+
+    lines.append("# HELP health_check_shard_members Number of replicas sharing the models, this one included (1 without sharding)")
+    lines.append("# TYPE health_check_shard_members gauge")
+    lines.append(f"health_check_shard_members {len(membership.ring.members) if membership is not None else 1}")
+    lines.append("# HELP health_check_shard_models Number of models of the family in this replica's shard")
+    lines.append("# TYPE health_check_shard_models gauge")
+    for prefix, state in family_state.items():
+        lines.append(f'health_check_shard_models{{family="{prefix}"}} {len({r.get("model", "") for r in state["results"]})}')
+    lines.append("# HELP health_check_shard_rebalances_total Number of times the shards were reassigned after replicas came or went")
+    lines.append("# TYPE health_check_shard_rebalances_total counter")
+    lines.append(f"health_check_shard_rebalances_total {shard_state['rebalances_total']}")
+    lines.append("# HELP health_check_shard_lease_errors_total Number of failed renewals of this replica's shard lease")
+    lines.append("# TYPE health_check_shard_lease_errors_total counter")
+    lines.append(f"health_check_shard_lease_errors_total {shard_state['lease_errors_total']}")
+
+    family_metrics = (
+        ("family_run_duration_seconds", "gauge", "Wall-clock duration of the last probe run of the family", "run_duration"),
+        ("family_runs_total", "counter", "Number of completed probe runs of the family", "runs_total"),
+        ("family_runs_in_progress", "gauge", "Number of probe runs of the family currently executing", "runs_in_progress"),
+        ("models_in_running_batches", "gauge", "Number of models covered by the family's probe runs still executing, probed or queued (an upper bound on its concurrent probes)", "models_in_running_batches"),
+        ("probe_timeouts_total", "counter", "Number of probes that hit a timeout", "timeouts_total"),
+        ("probe_prompt_tokens_total", "counter", "Prompt tokens consumed by probes, from the reported usage", "prompt_tokens_total"),
+        ("probe_completion_tokens_total", "counter", "Completion tokens consumed by probes, from the reported usage", "completion_tokens_total"),
+    )
+    for name, metric_type, help_text, key in family_metrics:
+        lines.append(f"# HELP health_check_{name} {help_text}")
+        lines.append(f"# TYPE health_check_{name} {metric_type}")
+        for family, value in service_stats[key].items():
+            lines.append(f'health_check_{name}{{family="{family}"}} {value}')
+
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+def publish_metrics():
+    """Re-render /metrics and swap the cached payload in. Called whenever results change."""
+    global metrics_snapshot
+    with data_lock:
+        body = render_metrics()
+        metrics_state["rendered"] += 1
+        generation = metrics_state["rendered"]
+    body_gzip = gzip.compress(body)
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    with snapshot_lock:
+        # Threads publish concurrently; a render that finished compressing late must not
+        # replace a newer one
+        if generation > metrics_state["published"]:
+            metrics_state["published"] = generation
+            # Single reference assignment, so scrapes see either the old or the new snapshot
+            metrics_snapshot = (body, body_gzip, etag)
+
+def run_probe(family, model):
+    """Probe one model on the probe executor, cache the outcome and free its probe slot."""
+    key = (family, model)
+    try:
+        results, error = run_family(*FAMILY_BY_PREFIX[family], models=[model])
+        outcome = (results, error, time.time())
+        with probe_lock:
+            probe_cache[key] = outcome
+        return outcome
+    finally:
+        with probe_lock:
+            del probe_inflight[key]
+        probe_slots.release()
+
+def admit_probe(caller):
+    """Take a probe slot and a rate limit token of `caller` and of all callers together.
+
+    Returns None if a new probe may start, else the (status, message, retry_after) to refuse it with.
+    """
+    if not probe_slots.acquire(blocking=False):
+        return 503, "Too many on-demand probes in progress", 10
+    now = time.time()
+    allowed, retry_after = probe_rate_limiter.allow(caller, now)
+    if allowed:
+        # A shared bucket caps the total so many callers together cannot flood suppliers either
+        allowed, retry_after = probe_rate_limiter.allow("*", now)
+        if not allowed:
+            probe_rate_limiter.refund(caller)
+    if not allowed:
+        probe_slots.release()
+        return 429, "Rate limit exceeded", retry_after
+    return None
+
+def probe_on_demand(family, model, caller):
+    """Probe one model now, reusing a recent result and sharing in-flight probes.
+
+    Only a request that starts a new probe is charged a probe slot and rate limit tokens.
+    Returns ((results, error, timestamp, cached), None), or (None, (status, message,
+    retry_after)) if the request is refused.
+    """
+    key = (family, model)
+    with probe_lock:
+        cached = probe_cache.get(key)
+        if cached is not None and time.time() - cached[2] < PROBE_CACHE_SECONDS:
+            return cached + (True,), None
+        if not probe_waiters.acquire(blocking=False):
+            return None, (503, "Too many on-demand probes in progress", 10)
+        future = probe_inflight.get(key)
+        if future is None:
+            refusal = admit_probe(caller)
+            if refusal is not None:
+                probe_waiters.release()
+                return None, refusal
+            future = probe_inflight[key] = probe_executor.submit(run_probe, family, model)
+    try:
+        return future.result() + (False,), None
+    finally:
+        probe_waiters.release()
 
 def scheduler_loop():
     while True:
         run_health_check()
-        time.sleep(3600)
+        if CORRELATED_PROBE_INTERVAL > 0 and time.time() >= correlated_state["next_due"]:
+            correlated_state["next_due"] = time.time() + CORRELATED_PROBE_INTERVAL
+            run_correlated_probes()
+        if LONG_CONTEXT_PROBE_INTERVAL > 0 and time.time() >= long_context_state["next_due"] and not long_context_state["running"]:
+            long_context_state["next_due"] = time.time() + LONG_CONTEXT_PROBE_INTERVAL
+            long_context_state["running"] = True
+            threading.Thread(target=run_long_context_probes, daemon=True).start()
+        if CANARY_PROBE_INTERVAL > 0 and time.time() >= canary_state["next_due"]:
+            canary_state["next_due"] = time.time() + CANARY_PROBE_INTERVAL
+            run_canary_probes()
+        if BATCH_PROBE_INTERVAL > 0 and time.time() >= batch_state["next_due"]:
+            batch_state["next_due"] = time.time() + BATCH_PROBE_INTERVAL
+            run_batch_probes()
+        run_keep_warm_pings()
+        time.sleep(PROBE_TICK_SECONDS)
+
+class BoundedThreadingHTTPServer(HTTPServer):
+    """HTTPServer that handles connections on a fixed-size pool of worker threads.
+
+    A connection only gets a worker once it has a request to read: until then, and between
+    the requests of a keep-alive connection, it waits in a selector, and is closed after
+    `idle_timeout` seconds without one. Idle connections therefore cannot hold workers away
+    from scrapes. At most `max_backlog` connections beyond the workers may be open; further
+    connections get an immediate 503, so a connection flood cannot pile up open sockets.
+    """
+
+    def __init__(self, server_address, handler_class, max_workers=8, max_backlog=64, idle_timeout=5):
+        # Let the kernel queue a burst of connections too, instead of making clients retry their SYN
+        self.request_queue_size = max(max_backlog, self.request_queue_size)
+        super().__init__(server_address, handler_class)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="http")
+        self.max_connections = max_workers + max_backlog
+        self.connections = 0  # accepted and not yet closed; only changed under connections_lock
+        self.connections_lock = threading.Lock()
+        self.idle_timeout = idle_timeout
+        # Connections to watch are handed to the watcher thread, which alone touches the selector
+        self.idle_selector = selectors.DefaultSelector()
+        self.idle_handoff = []
+        self.idle_lock = threading.Lock()
+        self.wakeup, self.wakeup_sender = socket.socketpair()
+        self.idle_selector.register(self.wakeup, selectors.EVENT_READ)
+        threading.Thread(target=self.watch_idle, daemon=True, name="http-idle").start()
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            admitted = self.connections < self.max_connections
+            if admitted:
+                self.connections += 1
+        if not admitted:
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\nRetry-After: 1\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.wait_for_request(request, client_address)
+
+    def wait_for_request(self, request, client_address):
+        """Park `request` until it is readable, then hand it to a worker."""
+        with self.idle_lock:
+            self.idle_handoff.append((request, client_address))
+        try:
+            self.wakeup_sender.send(b"\0")
+        except OSError:
+            pass
+
+    def watch_idle(self):
+        while True:
+            with self.idle_lock:
+                handoff, self.idle_handoff = self.idle_handoff, []
+            now = time.monotonic()
+            for request, client_address in handoff:
+                self.idle_selector.register(request, selectors.EVENT_READ, (client_address, now + self.idle_timeout))
+            parked = [key for key in self.idle_selector.get_map().values() if key.data is not None]
+            for key in parked:
+                if key.data[1] <= now:
+                    self.idle_selector.unregister(key.fileobj)
+                    self.close_request_slot(key.fileobj)
+            timeout = min((key.data[1] for key in parked if key.data[1] > now), default=now + 1) - now
+            for key, _ in self.idle_selector.select(max(timeout, 0)):
+                if key.data is None:
+                    self.wakeup.recv(4096)
+                    continue
+                self.idle_selector.unregister(key.fileobj)
+                try:
+                    self.executor.submit(self.process_request_thread, key.fileobj, key.data[0])
+                except RuntimeError:
+                    # The executor is shut down along with the server
+                    self.close_request_slot(key.fileobj)
+
+    def process_request_thread(self, request, client_address):
+        handler = None
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+        if getattr(handler, "idle", False):
+            self.wait_for_request(request, client_address)
+        else:
+            self.close_request_slot(request)
+
+    def close_request_slot(self, request):
+        self.shutdown_request(request)
+        with self.connections_lock:
+            self.connections -= 1
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
 
 class MetricsHandler(BaseHTTPRequestHandler):
+    # Keep-alive for scrapers. A request must arrive within `timeout` seconds once it has
+    # started; between requests the connection waits in the server without a worker
+    protocol_version = "HTTP/1.1"
+    timeout = float(os.environ.get("HTTP_TIMEOUT", 10))
+    # Headers and body are written separately; without TCP_NODELAY keep-alive responses stall on delayed ACKs
+    disable_nagle_algorithm = True
+
     def log_message(self, format, *args):
         # Log server requests in JSON format
         logger.info(format % args, extra={
             "client_address": self.client_address[0],
-            "request_line": self.requestline
+            "request_line": getattr(self, "requestline", "")
         })
 
+    def handle(self):
+        """Serve the requests the client has already sent, then hand an idle keep-alive
+        connection back to the server (`idle`) instead of blocking on the next one."""
+        self.idle = False
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.connection.settimeout(0)
+            try:
+                pending = self.rfile.peek(1)
+            except OSError:
+                return
+            self.connection.settimeout(self.timeout)
+            if not pending:
+                self.idle = True
+                return
+            self.handle_one_request()
+
+    def send_chunked_json(self, key, items):
+        """Send {key: [items...]} with chunked encoding, encoding `items` as they are consumed."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        parts = [b'{"%s": [' % key.encode("utf-8")]
+        separator = b""
+        for item in items:
+            parts.append(separator + json.dumps(item).encode("utf-8"))
+            separator = b", "
+            if len(parts) >= 256:
+                self.write_chunk(b"".join(parts))
+                parts = []
+        parts.append(b"]}")
+        self.write_chunk(b"".join(parts))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, indent=2).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self):
-        if self.path == "/metrics":
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/metrics":
+            # Serve the pre-rendered snapshot; no lock needed since it is swapped in whole
+            body, body_gzip, etag = metrics_snapshot
+            if etag in self.headers.get("If-None-Match", ""):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
             self.send_response(200)
             self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = body_gzip
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
+            self.wfile.write(body)
 
-            lines = []
-            with data_lock:
-                lines.append("# HELP huggingface_last_run_timestamp_seconds Unix timestamp of the last health check run")
-                lines.append("# TYPE huggingface_last_run_timestamp_seconds gauge")
-                lines.append(f"huggingface_last_run_timestamp_seconds {last_run_timestamp}")
-
-                global_success = 1 if last_error is None else 0
-                lines.append("# HELP huggingface_test_global_success Overall status of the health checks (1 = success, 0 = failure)")
-                lines.append("# TYPE huggingface_test_global_success gauge")
-                lines.append(f"huggingface_test_global_success {global_success}")
-
-                lines.append("# HELP huggingface_model_test_success Success status of individual model test (1 = success, 0 = failure)")
-                lines.append("# TYPE huggingface_model_test_success gauge")
-                for r in latest_results:
-                    model = r.get("model", "")
-                    success_val = 1 if r.get("success", False) else 0
-                    lines.append(f'huggingface_model_test_success{{model="{model}"}} {success_val}')
-
-                lines.append("# HELP huggingface_model_ttft_seconds Time to First Token (TTFT) in seconds for model")
-                lines.append("# TYPE huggingface_model_ttft_seconds gauge")
-                for r in latest_results:
-                    model = r.get("model", "")
-                    ttft = r.get("ttft")
-                    if ttft is not None:
-                        lines.append(f'huggingface_model_ttft_seconds{{model="{model}"}} {ttft}')
-                    else:
-                        lines.append(f'huggingface_model_ttft_seconds{{model="{model}"}} NaN')
-
-                # --- Suppliers Metrics ---
-                lines.append("# HELP suppliers_last_run_timestamp_seconds Unix timestamp of the last health check run")
-                lines.append("# TYPE suppliers_last_run_timestamp_seconds gauge")
-                lines.append(f"suppliers_last_run_timestamp_seconds {suppliers_last_run_timestamp}")
-
-                suppliers_global_success = 1 if suppliers_last_error is None else 0
-                lines.append("# HELP suppliers_test_global_success Overall status of the health checks (1 = success, 0 = failure)")
-                lines.append("# TYPE suppliers_test_global_success gauge")
-                lines.append(f"suppliers_test_global_success {suppliers_global_success}")
-
-                lines.append("# HELP suppliers_model_test_success Success status of individual model test (1 = success, 0 = failure)")
-                lines.append("# TYPE suppliers_model_test_success gauge")
-                for r in suppliers_results:
-                    model = r.get("model", "")
-                    success_val = 1 if r.get("success", False) else 0
-                    lines.append(f'suppliers_model_test_success{{model="{model}"}} {success_val}')
-
-                lines.append("# HELP suppliers_model_ttft_seconds Time to First Token (TTFT) in seconds for model")
-                lines.append("# TYPE suppliers_model_ttft_seconds gauge")
-                for r in suppliers_results:
-                    model = r.get("model", "")
-                    ttft = r.get("ttft")
-                    if ttft is not None:
-                        lines.append(f'suppliers_model_ttft_seconds{{model="{model}"}} {ttft}')
-                    else:
-                        lines.append(f'suppliers_model_ttft_seconds{{model="{model}"}} NaN')
-
-                # --- LiteLLM Metrics ---
-                lines.append("# HELP litellm_router_last_run_timestamp_seconds Unix timestamp of the last health check run")
-                lines.append("# TYPE litellm_router_last_run_timestamp_seconds gauge")
-                lines.append(f"litellm_router_last_run_timestamp_seconds {litellm_last_run_timestamp}")
-
-                litellm_global_success = 1 if litellm_last_error is None else 0
-                lines.append("# HELP litellm_router_test_global_success Overall status of the health checks (1 = success, 0 = failure)")
-                lines.append("# TYPE litellm_router_test_global_success gauge")
-                lines.append(f"litellm_router_test_global_success {litellm_global_success}")
-
-                lines.append("# HELP litellm_router_model_test_success Success status of individual model test (1 = success, 0 = failure)")
-                lines.append("# TYPE litellm_router_model_test_success gauge")
-                for r in litellm_results:
-                    model = r.get("model", "")
-                    success_val = 1 if r.get("success", False) else 0
-                    lines.append(f'litellm_router_model_test_success{{model="{model}"}} {success_val}')
-
-                lines.append("# HELP litellm_router_model_ttft_seconds Time to First Token (TTFT) in seconds for model")
-                lines.append("# TYPE litellm_router_model_ttft_seconds gauge")
-                for r in litellm_results:
-                    model = r.get("model", "")
-                    ttft = r.get("ttft")
-                    if ttft is not None:
-                        lines.append(f'litellm_router_model_ttft_seconds{{model="{model}"}} {ttft}')
-                    else:
-                        lines.append(f'litellm_router_model_ttft_seconds{{model="{model}"}} NaN')
-
-                # --- Zuplo Metrics ---
-                lines.append("# HELP zuplo_last_run_timestamp_seconds Unix timestamp of the last health check run")
-                lines.append("# TYPE zuplo_last_run_timestamp_seconds gauge")
-                lines.append(f"zuplo_last_run_timestamp_seconds {zuplo_last_run_timestamp}")
-
-                zuplo_global_success = 1 if zuplo_last_error is None else 0
-                lines.append("# HELP zuplo_test_global_success Overall status of the health checks (1 = success, 0 = failure)")
-                lines.append("# TYPE zuplo_test_global_success gauge")
-                lines.append(f"zuplo_test_global_success {zuplo_global_success}")
-
-                lines.append("# HELP zuplo_model_test_success Success status of individual model test (1 = success, 0 = failure)")
-                lines.append("# TYPE zuplo_model_test_success gauge")
-                for r in zuplo_results:
-                    model = r.get("model", "")
-                    success_val = 1 if r.get("success", False) else 0
-                    lines.append(f'zuplo_model_test_success{{model="{model}"}} {success_val}')
-
-                lines.append("# HELP zuplo_model_ttft_seconds Time to First Token (TTFT) in seconds for model")
-                lines.append("# TYPE zuplo_model_ttft_seconds gauge")
-                for r in zuplo_results:
-                    model = r.get("model", "")
-                    ttft = r.get("ttft")
-                    if ttft is not None:
-                        lines.append(f'zuplo_model_ttft_seconds{{model="{model}"}} {ttft}')
-                    else:
-                        lines.append(f'zuplo_model_ttft_seconds{{model="{model}"}} NaN')
-
-            self.wfile.write(("\n".join(lines) + "\n").encode("utf-8"))
-
-        elif self.path in ("/healthz", "/"):
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
+        elif url.path in ("/healthz", "/"):
             with data_lock:
+                states = [family_state[family] for family, _, _, _ in FAMILIES]
                 status = {
-                    "last_run_timestamp": max(last_run_timestamp, suppliers_last_run_timestamp, litellm_last_run_timestamp, zuplo_last_run_timestamp),
-                    "last_error": last_error or suppliers_last_error or litellm_last_error or zuplo_last_error,
-                    "success": last_error is None and suppliers_last_error is None and litellm_last_error is None and zuplo_last_error is None,
-                    "huggingface": {
-                        "last_run_timestamp": last_run_timestamp,
-                        "last_error": last_error,
-                        "success": last_error is None
-                    },
-                    "suppliers": {
-                        "last_run_timestamp": suppliers_last_run_timestamp,
-                        "last_error": suppliers_last_error,
-                        "success": suppliers_last_error is None
-                    },
-                    "litellm_router": {
-                        "last_run_timestamp": litellm_last_run_timestamp,
-                        "last_error": litellm_last_error,
-                        "success": litellm_last_error is None
-                    },
-                    "zuplo": {
-                        "last_run_timestamp": zuplo_last_run_timestamp,
-                        "last_error": zuplo_last_error,
-                        "success": zuplo_last_error is None
-                    }
+                    "last_run_timestamp": max(s["last_run_timestamp"] for s in states),
+                    "last_error": next((s["last_error"] for s in states if s["last_error"]), None),
+                    "success": all(s["last_error"] is None for s in states),
                 }
-            self.wfile.write(json.dumps(status, indent=2).encode("utf-8"))
+                for family, _, _, _ in FAMILIES:
+                    state = family_state[family]
+                    status[family] = {
+                        "last_run_timestamp": state["last_run_timestamp"],
+                        "last_error": state["last_error"],
+                        "success": state["last_error"] is None
+                    }
+            self.send_json(200, status)
+
+        elif url.path == "/history":
+            if probe_store is None:
+                self.send_json(503, {"error": "Probe history is not enabled"})
+                return
+            params = urllib.parse.parse_qs(url.query)
+            try:
+                since = float(params.get("since", ["0"])[0])
+            except ValueError:
+                self.send_json(400, {"error": "'since' must be a Unix timestamp"})
+                return
+            try:
+                limit = min(int(params.get("limit", [HISTORY_LIMIT])[0]), HISTORY_LIMIT)
+            except ValueError:
+                self.send_json(400, {"error": "'limit' must be an integer"})
+                return
+            records = probe_store.query(
+                family=params.get("family", [None])[0],
+                model=params.get("model", [None])[0],
+                since=since,
+                limit=limit
+            )
+            self.send_chunked_json("results", records)
         else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b"Not Found")
+            self.send_not_found()
+
+    def do_POST(self):
+        # Drain any request body so the connection can be reused
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/probe":
+            self.send_not_found()
+            return
+
+        params = urllib.parse.parse_qs(url.query)
+        family = params.get("family", [None])[0]
+        model = params.get("model", [None])[0]
+        if family not in FAMILY_BY_PREFIX or not model:
+            self.send_json(400, {"error": f"'family' must be one of {', '.join(FAMILY_BY_PREFIX)} and 'model' is required"})
+            return
+
+        outcome, refusal = probe_on_demand(family, model, self.client_address[0])
+        if refusal is not None:
+            self.send_retry(*refusal)
+            return
+        self.send_probe(family, model, *outcome)
+
+    def send_probe(self, family, model, results, error, timestamp, cached):
+        if not results and error is None:
+            self.send_json(404, {"error": f"Model '{model}' not found in {family}"})
+            return
+        self.send_json(200, {
+            "family": family,
+            "model": model,
+            "timestamp": timestamp,
+            "cached": cached,
+            "success": error is None,
+            "error": error,
+            "results": results
+        })
+
+    def send_retry(self, code, message, retry_after):
+        body = json.dumps({"error": message}).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Retry-After", str(int(retry_after) + 1))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_found(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "9")
+        self.end_headers()
+        self.wfile.write(b"Not Found")
 
 def main():
+    global probe_store, membership
+    try:
+        probe_store = ProbeStore(HISTORY_PATH, HISTORY_CAPACITY)
+        restore_from_history()
+        logger.info(f"Restored probe history from {HISTORY_PATH}")
+    except Exception as e:
+        probe_store = None
+        logger.error(f"Probe history disabled, could not open {HISTORY_PATH}: {e}", exc_info=True)
+    if SHARD_LEASE_URL:
+        membership = Membership(open_leases(SHARD_LEASE_URL), REPLICA_ID, SHARD_LEASE_TTL)
+        renew_lease()
+        threading.Thread(target=lease_loop, daemon=True).start()
+        # Hand the shard over at once on shutdown (e.g. a rolling update) instead of after the lease TTL
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    publish_metrics()
+
     t = threading.Thread(target=scheduler_loop, daemon=True)
     t.start()
 
     port = int(os.environ.get("PORT", 8000))
+    workers = int(os.environ.get("HTTP_WORKERS", 8))
+    backlog = int(os.environ.get("HTTP_MAX_BACKLOG", 64))
+    idle_timeout = float(os.environ.get("HTTP_IDLE_TIMEOUT", 5))
     server_address = ("", port)
-    httpd = HTTPServer(server_address, MetricsHandler)
-    logger.info(f"Starting server on port {port}...")
+    httpd = BoundedThreadingHTTPServer(server_address, MetricsHandler, max_workers=workers, max_backlog=backlog, idle_timeout=idle_timeout)
+    logger.info(f"Starting server on port {port} with {workers} workers...")
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         pass
+    finally:
+        if membership is not None:
+            try:
+                membership.release()
+            except Exception as e:
+                logger.error(f"Could not release the shard lease of {REPLICA_ID}: {e}")
+    httpd.server_close()
     logger.info("Server stopped.")
 
 if __name__ == "__main__":
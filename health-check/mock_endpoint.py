@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Local OpenAI-compatible endpoint for trying out the probes without a real supplier.
+
+Serves /v1/models, streaming /v1/chat/completions (with the usage report),
+/v1/embeddings and /v1/rerank. Chat requests with tools get a streamed call of the
+first tool, and models named *-thinking stream reasoning_content first. Only --capacity requests are served at once and the
+rest queue, so `suppliers.py --load` finds a knee around that concurrency. With
+--deployments N, requests are routed at random to N deployments, the i-th one i times
+slower, named in LiteLLM's x-litellm-model-id / x-litellm-model-api-base headers. For example:
+
+    python mock_endpoint.py --port 18080 --capacity 8 &
+    # models/mock.yaml:
+    #   models:
+    #     - model_name: mock
+    #       litellm_params: {model: openai/mock, api_base: "http://127.0.0.1:18080/v1"}
+    MODELS_DIR=models python suppliers.py --models mock --load
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        deployment = getattr(self, "deployment", None)
+        if deployment:
+            self.send_header("x-litellm-model-id", f"mock-deployment-{deployment}")
+            self.send_header("x-litellm-model-api-base", f"http://supplier-{deployment}.invalid/v1")
+
+    def send_body(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        self.deployment = None
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_body(200, {"object": "list", "data": [{"id": name, "object": "model"} for name in self.server.models]})
+        else:
+            self.send_body(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.rstrip("/")
+        self.deployment = random.randint(1, self.server.deployments) if self.server.deployments else None
+
+        with self.server.slots:
+            time.sleep(self.server.ttft * (self.deployment or 1))
+            if path.endswith("/embeddings"):
+                inputs = request.get("input", [])
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                time.sleep(self.server.item_delay * len(inputs))
+                self.send_body(200, {
+                    "object": "list",
+                    "data": [{"object": "embedding", "index": i, "embedding": [0.0] * 8} for i in range(len(inputs))],
+                    "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)}
+                })
+                return
+            if path.endswith("/rerank"):
+                documents = request.get("documents", [])
+                time.sleep(self.server.item_delay * len(documents))
+                self.send_body(200, {
+                    "id": "rerank-mock",
+                    "results": [{"index": i, "relevance_score": 1.0 / (i + 1)} for i in range(len(documents))]
+                })
+                return
+            if not path.endswith("/chat/completions"):
+                self.send_body(404, {"error": {"message": "not found"}})
+                return
+
+            # About 4 characters per token; long prompts take prompt_tokens / --prefill-rate to prefill
+            prompt_tokens = max(1, sum(len(str(m.get("content", ""))) for m in request.get("messages", [])) // 4)
+            time.sleep(prompt_tokens / self.server.prefill_rate)
+            tokens = int(request.get("max_tokens") or 16)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": request.get("model")}
+            if request.get("tools"):
+                # Call the first tool, arguments streamed in two parts
+                function = request["tools"][0]["function"]
+                deltas = [
+                    {"role": "assistant", "tool_calls": [{"index": 0, "id": "call-mock", "type": "function", "function": {"name": function["name"], "arguments": '{"city": '}}]},
+                    {"tool_calls": [{"index": 0, "function": {"arguments": '"Zurich"}'}}]},
+                ]
+            else:
+                # Models named *-thinking reason for a quarter of the answer first
+                thinking = tokens // 4 if str(request.get("model", "")).endswith("-thinking") else 0
+                deltas = [{"reasoning_content": f" step {i}"} for i in range(1, thinking + 1)]
+                deltas += [{"content": f" {i}"} for i in range(1, tokens - thinking + 1)]
+                deltas[0] = dict(deltas[0], role="assistant")
+            for i, delta in enumerate(deltas):
+                if i:
+                    time.sleep(self.server.token_delay)
+                self.write_chunk(b"data: " + json.dumps(dict(chunk, choices=[{"index": 0, "delta": delta}])).encode() + b"\n\n")
+            if (request.get("stream_options") or {}).get("include_usage"):
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": tokens, "total_tokens": tokens + prompt_tokens}
+                self.write_chunk(b"data: " + json.dumps(dict(chunk, choices=[], usage=usage)).encode() + b"\n\n")
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock endpoint")
+    parser.add_argument("--port", type=int, default=18080, help="Port to listen on (127.0.0.1)")
+    parser.add_argument("--capacity", type=int, default=8, help="Requests served concurrently; the rest queue")
+    parser.add_argument("--ttft", type=float, default=0.05, help="Seconds before the first token")
+    parser.add_argument("--prefill-rate", type=float, default=50000, help="Prompt tokens prefilled per second")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="Seconds between streamed tokens")
+    parser.add_argument("--item-delay", type=float, default=0.001, help="Seconds per embedding input or rerank document")
+    parser.add_argument("--deployments", type=int, default=0, help="Route requests at random to this many deployments named in LiteLLM response headers")
+    parser.add_argument("--models", default="mock,mock-embed,mock-rerank", help="Comma-separated model ids listed by /v1/models")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), MockHandler)
+    server.daemon_threads = True
+    server.slots = threading.BoundedSemaphore(args.capacity)
+    server.ttft = args.ttft
+    server.prefill_rate = args.prefill_rate
+    server.token_delay = args.token_delay
+    server.item_delay = args.item_delay
+    server.deployments = args.deployments
+    server.models = args.models.split(",")
+    print(f"Mock endpoint on http://127.0.0.1:{args.port}/v1 (capacity {args.capacity})")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
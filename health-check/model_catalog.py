@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import contextlib
+import subprocess
+
+REPO_URL = "https://github.com/forpublicai/chat.publicai.co.git"
+
+# Location of the LiteLLM model files inside the repository, newest layout first
+MODELS_SUBDIRS = (
+    "charts/platform/charts/litellm/models",
+    "charts/web_services/charts/litellm/models",
+)
+
+# Bumped whenever the index layout or parse_active_endpoints() output changes
+INDEX_VERSION = 1
+
+def find_models_dir(root_dir):
+    """Return the first models directory of MODELS_SUBDIRS that exists under `root_dir`."""
+    for subdir in MODELS_SUBDIRS:
+        path = os.path.join(root_dir, subdir)
+        if os.path.isdir(path):
+            return path
+    return os.path.join(root_dir, MODELS_SUBDIRS[0])
+
+def model_files(models_dir):
+    """Return the model YAML paths under `models_dir` in a stable order."""
+    paths = []
+    for root_dir, _, files in sorted(os.walk(models_dir)):
+        for file in sorted(files):
+            if file.endswith('.yaml') or file.endswith('.yml'):
+                paths.append(os.path.join(root_dir, file))
+    return paths
+
+def parse_active_endpoints(models_dir, verbose=True):
+    """Parse active LLM endpoints from the litellm models directory."""
+    import yaml
+    if not os.path.exists(models_dir):
+        raise FileNotFoundError(f"models directory not found at {models_dir}")
+
+    models = []
+
+    for file_path in model_files(models_dir):
+        try:
+            with open(file_path, 'r') as f:
+                data = yaml.safe_load(f)
+            if not data or 'models' not in data:
+                continue
+            for m in data['models']:
+                model_name = m.get('model_name')
+                if not model_name:
+                    continue
+                litellm_params = m.get('litellm_params', {})
+                # Only test endpoints that have api_base
+                if 'api_base' in litellm_params:
+                    models.append({
+                        'model_name': model_name,
+                        'litellm_params': litellm_params
+                    })
+        except Exception as e:
+            if verbose:
+                print(f"Error parsing model file {file_path}: {e}", file=sys.stderr)
+
+    return models
+
+def catalog_hash(models_dir):
+    """SHA-256 over the relative path and content of every model YAML under `models_dir`."""
+    digest = hashlib.sha256(b"%d\0" % INDEX_VERSION)
+    for file_path in model_files(models_dir):
+        digest.update(os.path.relpath(file_path, models_dir).encode("utf-8") + b"\0")
+        with open(file_path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+def load_endpoints(models_dir, index_path, verbose=True):
+    """Return parse_active_endpoints(models_dir), reusing the serialized index at `index_path`.
+
+    The index is keyed by catalog_hash(), so YAML files are only parsed again when their
+    content changed; otherwise loading costs one hash pass and one JSON read.
+    """
+    if not os.path.exists(models_dir):
+        raise FileNotFoundError(f"models directory not found at {models_dir}")
+    content_hash = catalog_hash(models_dir)
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        if index.get("hash") == content_hash:
+            return index["endpoints"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    endpoints = parse_active_endpoints(models_dir, verbose=verbose)
+    try:
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"hash": content_hash, "endpoints": endpoints}, f, separators=(",", ":"))
+        os.replace(tmp_path, index_path)
+    except (OSError, TypeError, ValueError) as e:
+        # Not fatal: the next run simply parses the YAML files again
+        if verbose:
+            print(f"Could not write model index {index_path}: {e}", file=sys.stderr)
+    return endpoints
+
+def _git(*args, timeout=120):
+    result = subprocess.run(
+        ["git", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        timeout=timeout
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"git {args[0]} failed: {result.stderr.strip()}")
+    return result.stdout.strip()
+
+def upstream_commit(repo_url=REPO_URL):
+    """Return the commit id of the remote HEAD without fetching anything."""
+    out = _git("ls-remote", repo_url, "HEAD", timeout=30)
+    if not out:
+        raise RuntimeError(f"git ls-remote returned no HEAD for {repo_url}")
+    return out.split()[0]
+
+@contextlib.contextmanager
+def checkout_lock(checkout_dir):
+    """Hold an exclusive lock on `checkout_dir` (a `.lock` file next to it) while syncing or reading it.
+
+    Several probe runs can start at once (scheduler ticks, long-context runs, on-demand probes),
+    and one must not reset or re-clone the checkout while another reads it.
+    """
+    lock_path = f"{os.path.abspath(checkout_dir)}.lock"
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def sync_checkout(checkout_dir, repo_url=REPO_URL, log=print):
+    """Keep `checkout_dir` at the upstream HEAD, fetching only when the commit changed.
+
+    The checkout is shallow and sparse (just MODELS_SUBDIRS). If the remote cannot be
+    reached an existing checkout is used as is. Returns the models directory. Callers hold
+    checkout_lock() across the sync and their reads of the models directory.
+    """
+    have_checkout = os.path.isdir(os.path.join(checkout_dir, ".git"))
+    try:
+        commit = upstream_commit(repo_url)
+    except Exception as e:
+        if not have_checkout:
+            raise
+        log(f"Could not check upstream commit ({e}); using the existing checkout.")
+        return find_models_dir(checkout_dir)
+
+    if have_checkout:
+        try:
+            if _git("-C", checkout_dir, "rev-parse", "HEAD") == commit:
+                log(f"Model catalog is up to date at {commit[:12]}.")
+                return find_models_dir(checkout_dir)
+            log(f"Updating model catalog to {commit[:12]}...")
+            _git("-C", checkout_dir, "fetch", "--depth", "1", "origin", commit)
+            _git("-C", checkout_dir, "reset", "--hard", "FETCH_HEAD")
+            return find_models_dir(checkout_dir)
+        except Exception as e:
+            log(f"Updating the existing checkout failed ({e}); cloning again.")
+
+    log(f"Cloning model catalog at {commit[:12]}...")
+    shutil.rmtree(checkout_dir, ignore_errors=True)
+    _git("clone", "--depth", "1", "--filter=blob:none", "--sparse", repo_url, checkout_dir)
+    _git("-C", checkout_dir, "sparse-checkout", "set", *MODELS_SUBDIRS)
+    return find_models_dir(checkout_dir)
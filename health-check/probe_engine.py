@@ -0,0 +1,807 @@
+"""Request plumbing shared by the probe scripts: pooled keep-alive connections, phase
+timing, stream parsing and a deadline-bounded worker pool.
+
+Probes run on threads over http.client rather than on an asyncio event loop. asyncio is
+in the standard library, but it has no HTTP client: an asyncio engine would mean writing
+HTTP/1.1 framing, chunked decoding and TLS session handling over asyncio streams, or
+adding aiohttp/httpx to an image that is deliberately stdlib-only (HTTP/2 would need a
+third-party library either way). Probes are I/O-bound and a script runs at most a few
+dozen at once, so a thread per in-flight probe costs little, keeps the per-phase timing
+on the blocking socket calls that define it, and fits the model of main.py running each
+family as a short-lived subprocess.
+"""
+import io
+import re
+import json
+import math
+import ssl
+import time
+import uuid
+import socket
+import threading
+import http.client
+import urllib.error
+import urllib.request
+import urllib.parse
+import contextlib
+import concurrent.futures
+
+from ttft_history import quantiles
+
+# Phases in the order they happen; their durations add up to the TTFT.
+# Requests on a reused keep-alive connection skip dns, connect and tls.
+PHASES = ("dns", "connect", "tls", "ttfb", "first_token")
+
+# Full-stream probes ask for a longer answer so decode speed can be measured
+FULL_STREAM_REQUEST = {
+    "messages": [
+        {"role": "user", "content": "Count from 1 to 100, separated by spaces"}
+    ],
+    "max_tokens": 256,
+}
+
+# Inter-token latency quantiles reported by full-stream probes
+ITL_QUANTILES = (0.5, 0.9, 0.99)
+
+# Concurrency steps of a load test; see load_test()
+LOAD_LEVELS = (1, 2, 4, 8, 16, 32, 64)
+
+# Batch sizes of embedding/rerank throughput probes, and a passage of typical RAG chunk
+# length (about 120 words) used for every input or document
+BATCH_SIZES = (1, 8, 32)
+BATCH_PASSAGE = (
+    "Public AI infrastructure provides open access to large language models that are "
+    "developed and hosted by public institutions. Requests are routed through a gateway "
+    "to inference suppliers in several countries, each running the models on their own "
+    "hardware. Documents uploaded by users are split into chunks of a few hundred tokens, "
+    "embedded, and stored in a vector index, so that relevant passages can be retrieved "
+    "and reranked before they are added to the prompt. The quality of the answers "
+    "therefore depends on the retrieval step as much as on the model itself, and slow "
+    "embedding or reranking directly delays both document ingestion and every answer "
+    "that uses retrieved context. Monitoring this path helps operators find bottlenecks."
+)
+RERANK_QUERY = "Why does slow embedding delay answers that use retrieved documents?"
+
+# Long-context probes: prompt sizes in tokens, as sent by RAG and long chats, and the answer
+# length requested after each prompt; see probe_long_context()
+LONG_CONTEXT_LENGTHS = (8192, 32768)
+LONG_GENERATION_TOKENS = 1024
+
+# Capability canaries: the smallest request that takes each capability's slow path (tool
+# parser, image encoder, reasoning parser); see probe_capability()
+CANARY_IMAGE = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAACAAAAAgCAIAAAD8GO2jAAAAKklEQVR42mO4oKBAU8QwasGoBaMWjFowasGoBaMWjFowasGoBaMWDBULAE7YQD2B7wk2AAAAAElFTkSuQmCC"
+CANARY_REQUESTS = {
+    "tools": {
+        "messages": [
+            {"role": "user", "content": "What is the weather in Zurich right now? Use the get_weather tool."}
+        ],
+        "tools": [{
+            "type": "function",
+            "function": {
+                "name": "get_weather",
+                "description": "Get the current weather in a city",
+                "parameters": {
+                    "type": "object",
+                    "properties": {"city": {"type": "string", "description": "Name of the city"}},
+                    "required": ["city"]
+                }
+            }
+        }],
+        "tool_choice": "auto",
+        "max_tokens": 64,
+    },
+    "vision": {
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "What colour is this image? Answer with one word."},
+                {"type": "image_url", "image_url": {"url": CANARY_IMAGE}}
+            ]
+        }],
+        "max_tokens": 10,
+    },
+    "reasoning": {
+        "messages": [
+            {"role": "user", "content": "What is 17 + 25? Answer with just the number."}
+        ],
+        "max_tokens": 512,
+    },
+}
+
+class PhaseTimer:
+    """Record consecutive phase durations of one request, starting at construction."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.phases = {}
+
+    def mark(self, phase):
+        """Close `phase` now; returns the total time elapsed since the start."""
+        now = time.perf_counter()
+        self.phases[phase] = now - self.last
+        self.last = now
+        return now - self.start
+
+# Shared SSL contexts by verification mode; see ssl_context()
+_ssl_contexts = {}
+_ssl_contexts_lock = threading.Lock()
+
+def ssl_context(verify=True):
+    """Return this process's SSL context for `verify` (False: no certificate checks).
+
+    Contexts are built once per mode: loading the CA bundle is costly, and TLS sessions
+    can only be resumed, and pooled connections only shared, within the same context.
+    """
+    with _ssl_contexts_lock:
+        context = _ssl_contexts.get(bool(verify))
+        if context is None:
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            _ssl_contexts[bool(verify)] = context
+        return context
+
+class ConnectionPool:
+    """Idle keep-alive connections, kept per (scheme, host, port, SSL context).
+
+    The last TLS session of each key is kept too, so a new connection to a host we
+    already talked to resumes the session instead of doing a full handshake.
+    """
+
+    def __init__(self, max_idle_per_host=16):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            return conns.pop() if conns else None
+
+    def release(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def session(self, key):
+        with self.lock:
+            return self.sessions.get(key)
+
+    def save_session(self, key, conn):
+        """Remember the TLS session of `conn`, if any, for the next connection to `key`."""
+        session = getattr(conn.sock, "session", None)
+        if session is not None:
+            with self.lock:
+                self.sessions[key] = session
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+# Shared by every probe in this process
+pool = ConnectionPool()
+
+# time.monotonic() by which every probe of this process must finish; see set_deadline()
+deadline = None
+
+def set_deadline(seconds):
+    """Bound all further probes of this process to `seconds` from now (None or 0: no bound)."""
+    global deadline
+    deadline = time.monotonic() + seconds if seconds else None
+
+def _deadline_timeout(timeout):
+    """Cap a request timeout to the time left before the deadline."""
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("timeout: probe run deadline exceeded")
+    return min(timeout, remaining)
+
+def run_probes(tasks, max_workers, keys=None, per_key=1):
+    """Run zero-argument callables on daemon worker threads until the deadline.
+
+    Returns a list in task order of ("done", value), ("error", exception) or ("timeout",
+    None). Workers stop taking new tasks once the deadline has passed, and the call
+    returns at the deadline at the latest. Probes still running then are abandoned; as
+    daemon threads they cannot keep the process alive.
+
+    With `keys` (one per task, e.g. the provider host) at most `per_key` tasks of a key
+    run at once. A free worker takes the first pending task whose key has room, so tasks
+    of a slow or saturated host wait in the queue rather than on a worker that tasks of
+    other hosts could use.
+    """
+    outcomes = [("timeout", None)] * len(tasks)
+    if not tasks:
+        return outcomes
+    lock = threading.Condition()
+    finished = threading.Event()
+    pending = list(range(len(tasks)))
+    running = {}  # key -> tasks of the key in progress
+    state = {"done": 0}
+
+    def take():
+        """Pop the next runnable task under `lock`, waiting while every pending key is full."""
+        while pending:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            for j, i in enumerate(pending):
+                if keys is None or running.get(keys[i], 0) < per_key:
+                    del pending[j]
+                    if keys is not None:
+                        running[keys[i]] = running.get(keys[i], 0) + 1
+                    return i
+            lock.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return None
+
+    def worker():
+        while True:
+            with lock:
+                i = take()
+                if i is None:
+                    return
+            try:
+                outcome = ("done", tasks[i]())
+            except Exception as e:
+                outcome = ("error", e)
+            with lock:
+                outcomes[i] = outcome
+                if keys is not None:
+                    running[keys[i]] -= 1
+                    lock.notify_all()
+                state["done"] += 1
+                if state["done"] == len(tasks):
+                    finished.set()
+
+    for _ in range(max(1, min(max_workers, len(tasks)))):
+        threading.Thread(target=worker, daemon=True).start()
+    finished.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+    with lock:
+        return list(outcomes)
+
+def _connect(https, host, port, context, timeout, timer, session=None):
+    """Open a new connection, timing dns, connect and tls on `timer`.
+
+    An HTTPS connection resumes `session` if the server still accepts it.
+    """
+    try:
+        addrinfo = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        timer.mark("dns")
+
+        sock = None
+        last_err = None
+        for family, socktype, proto, _, addr in addrinfo:
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.settimeout(timeout)
+                sock.connect(addr)
+                break
+            except OSError as e:
+                last_err = e
+                sock.close()
+                sock = None
+        if sock is None:
+            raise last_err or OSError(f"could not connect to {host}:{port}")
+        timer.mark("connect")
+
+        if https:
+            context = context or ssl_context()
+            try:
+                sock = context.wrap_socket(sock, server_hostname=host, session=session)
+            except OSError:
+                sock.close()
+                raise
+            timer.mark("tls")
+    except OSError as e:
+        raise urllib.error.URLError(e)
+
+    # The socket is already wrapped; the shared context keeps HTTPSConnection from loading
+    # a default one (and the CA bundle) for every new connection
+    if https:
+        conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=context)
+    else:
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    conn.sock = sock
+    return conn
+
+@contextlib.contextmanager
+def timed_urlopen(req, context=None, timeout=30, timer=None):
+    """Drop-in for urllib.request.urlopen(req) on pooled keep-alive connections.
+
+    Times dns, connect, tls (new connections only) and ttfb on `timer`; the caller
+    marks "first_token" itself. New HTTPS connections resume the host's last TLS
+    session. Like urlopen, HTTP error statuses raise urllib.error.HTTPError and
+    network failures raise urllib.error.URLError. The connection goes back to the
+    pool only if the response was read to the end.
+    """
+    timer = timer or PhaseTimer()
+    timeout = _deadline_timeout(timeout)
+    parts = urllib.parse.urlsplit(req.full_url)
+    https = parts.scheme == "https"
+    host = parts.hostname
+    port = parts.port or (443 if https else 80)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    context = context or (ssl_context() if https else None)
+    key = (parts.scheme, host, port, id(context))
+    headers = dict(req.header_items())
+
+    conn = pool.acquire(key)
+    response = None
+    try:
+        if conn is not None:
+            conn.sock.settimeout(timeout)
+            try:
+                conn.request(req.get_method(), path, body=req.data, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                # The server closed the idle connection; start over on a fresh one
+                conn.close()
+                conn = None
+                timer.last = time.perf_counter()
+        if conn is None:
+            conn = _connect(https, host, port, context, timeout, timer, pool.session(key) if https else None)
+            conn.request(req.get_method(), path, body=req.data, headers=headers)
+            response = conn.getresponse()
+        timer.mark("ttfb")
+
+        if response.status >= 400:
+            # Buffer the body so callers can still read error details after the connection is released
+            raise urllib.error.HTTPError(req.full_url, response.status, response.reason, response.headers, io.BytesIO(response.read()))
+        yield response
+    finally:
+        if conn is not None:
+            if https and conn.sock is not None:
+                # TLS 1.3 tickets arrive after the handshake, so take the session only now
+                pool.save_session(key, conn)
+            if response is not None and response.isclosed() and not response.will_close:
+                pool.release(key, conn)
+            else:
+                conn.close()
+
+# A non-empty delta object, i.e. a chunk carrying a token
+SSE_TOKEN = re.compile(rb'"delta"\s*:\s*\{\s*[^\s}]')
+
+class SSEParser:
+    """Incremental parser for the `data:` lines of an OpenAI-style chat completion stream.
+
+    Network reads are appended to one bytearray and only the complete lines they add are
+    scanned, in place, with bytes.find and a precompiled pattern; token chunks and [DONE]
+    are recognized without decoding anything. Only the usage report is JSON-decoded.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.done = False
+        self.usage = None
+
+    def _line_bounds(self, i, end):
+        """Return (start, stop) of the line containing index `i`."""
+        start = self.buffer.rfind(b"\n", 0, i) + 1
+        stop = self.buffer.find(b"\n", i, end)
+        return start, stop if stop >= 0 else end
+
+    def feed(self, data, count_tokens=True):
+        """Consume one network read; returns the number of token chunks it completed.
+
+        A token chunk is one whose delta is a non-empty object; pass count_tokens=False
+        to skip counting when only [DONE] and the usage report are still of interest.
+        Sets `done` on [DONE] and `usage` when the usage report arrives.
+        """
+        buf = self.buffer
+        buf += data
+        end = buf.rfind(b"\n", self.pos) + 1
+        if end <= self.pos:
+            return 0
+
+        i = buf.find(b"[DONE]", self.pos, end)
+        if i >= 0:
+            start, stop = self._line_bounds(i, end)
+            if buf.startswith(b"data:", start) and not buf[start + 5:i].strip():
+                end = start
+                self.done = True
+        tokens = len(SSE_TOKEN.findall(buf, self.pos, end)) if count_tokens else 0
+
+        i = buf.find(b'"usage"', self.pos, end)
+        while i >= 0:
+            start, stop = self._line_bounds(i, end)
+            # Most servers only send a usage object in the final chunk, others send null
+            value = buf.find(b":", i + 7, stop) + 1
+            while value and value < stop and buf[value] in b" \t":
+                value += 1
+            if value and value < stop and buf[value] == 123 and buf.startswith(b"data:", start):  # {
+                with memoryview(buf) as view:
+                    line = view[start + 5:stop].tobytes()
+                try:
+                    self.usage = json.loads(line).get('usage') or self.usage
+                except ValueError:
+                    pass
+            i = buf.find(b'"usage"', stop, end)
+
+        self.pos = end
+        # Drop consumed lines once they dominate the buffer; amortized O(1) per byte
+        if self.pos > 4096 and self.pos * 2 > len(buf):
+            del buf[:self.pos]
+            self.pos = 0
+        return tokens
+
+def stream_stats(start, arrivals, end, usage):
+    """Summarize a fully read stream from its token chunk arrival times.
+
+    `arrivals` starts with the first token; all times are time.perf_counter() values.
+    TPOT is (total latency - TTFT) / (output tokens - 1); inter-token latencies are the
+    gaps between streamed chunks, which may carry more than one token each.
+    """
+    ttft = arrivals[0] - start
+    total = end - start
+    tokens = (usage or {}).get('completion_tokens') or len(arrivals)
+    gaps = [b - a for a, b in zip(arrivals, arrivals[1:])]
+    return {
+        "total_latency": total,
+        "output_tokens": tokens,
+        "chunks": len(arrivals),
+        "tpot": (total - ttft) / (tokens - 1) if tokens > 1 else None,
+        "itl": {str(q): v for q, v in quantiles(gaps, ITL_QUANTILES).items()} if gaps else None,
+        "tokens_per_second": tokens / total if total > 0 else None,
+    }
+
+def read_chat_stream(response, timer, full_stream=False, read_size=8192):
+    """Read an SSE chat completion stream; returns (ttft, usage, stream).
+
+    The TTFT marks "first_token" on `timer` and is None if the stream ended without a
+    token. The stream is always drained to [DONE] for the usage report, which keeps the
+    connection reusable; with `full_stream` token arrival times are also recorded and
+    `stream` holds their stats (None otherwise).
+    """
+    parser = SSEParser()
+    ttft = None
+    arrivals = [] if full_stream else None
+    try:
+        while not parser.done:
+            if deadline is not None and time.monotonic() >= deadline:
+                if ttft is None:
+                    raise TimeoutError("timeout: probe run deadline exceeded")
+                # Keep the TTFT; the unread tail makes the connection unusable, so it is closed
+                break
+            data = response.read1(read_size)
+            if not data:
+                break
+            tokens = parser.feed(data, count_tokens=ttft is None or arrivals is not None)
+            if not tokens:
+                continue
+            if ttft is None:
+                ttft = timer.mark("first_token")
+                now = timer.last
+            else:
+                now = time.perf_counter()
+            if arrivals is not None:
+                # Chunks that came in the same read arrived at the same time
+                arrivals.extend([now] * tokens)
+        if parser.done:
+            # Consume the end of the body so the connection can be reused
+            response.read()
+    except OSError:
+        if ttft is None:
+            raise
+        # The TTFT is already measured; a stalled tail only costs us the usage numbers
+
+    if ttft is None:
+        return None, None, None
+    stream = None
+    if arrivals:
+        stream = stream_stats(timer.start, arrivals, time.perf_counter(), parser.usage)
+    return ttft, parser.usage, stream
+
+def read_body_usage(body):
+    """Return the `usage` object of a non-streaming JSON response body, if any."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data.get('usage') if isinstance(data, dict) else None
+
+def add_usage(usage, more):
+    """Return the token usage `usage` plus `more`, summing the counts present in either."""
+    if not more:
+        return usage
+    total = dict(usage or {})
+    for key, value in more.items():
+        if isinstance(value, (int, float)):
+            total[key] = (total.get(key) or 0) + value
+    return total
+
+# Response headers in which a LiteLLM proxy names the deployment that served the request
+DEPLOYMENT_HEADERS = (("id", "x-litellm-model-id"), ("api_base", "x-litellm-model-api-base"))
+
+def deployment_from_headers(headers):
+    """Return the LiteLLM deployment ({"id", "api_base"}) named in response `headers`, or None."""
+    if headers is None:
+        return None
+    deployment = {key: headers.get(name) for key, name in DEPLOYMENT_HEADERS}
+    return deployment if any(deployment.values()) else None
+
+def connection_state(phases):
+    """Return "cold" if the probe behind `phases` opened a new connection, "warm" if it
+    reused a pooled one, or None if it failed before getting a response."""
+    if "connect" in phases:
+        return "cold"
+    return "warm" if phases else None
+
+def format_error(e):
+    """Format a probe exception the way the probe scripts report errors."""
+    if isinstance(e, urllib.error.HTTPError):
+        try:
+            error_body = e.read().decode('utf-8')
+            return f"HTTP Error {e.code}: {e.reason} - Details: {error_body}"
+        except Exception:
+            return f"HTTP Error {e.code}: {e.reason}"
+    if isinstance(e, urllib.error.URLError):
+        return f"URL Error: {e.reason}"
+    return f"Exception: {type(e).__name__} - {str(e)}"
+
+def probe_chat_stream(url, payload, headers, context=None, timeout=30, full_stream=False):
+    """POST a streaming chat completion and measure its Time to First Token (TTFT).
+
+    Returns (success, ttft, error, phases, usage, stream); see read_chat_stream().
+    """
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode('utf-8'),
+        headers=headers,
+        method='POST'
+    )
+    timer = PhaseTimer()
+    try:
+        with timed_urlopen(req, context=context, timeout=timeout, timer=timer) as response:
+            ttft, usage, stream = read_chat_stream(response, timer, full_stream)
+            if ttft is None:
+                return False, None, "Response stream ended without any tokens", timer.phases, None, None
+            return True, ttft, None, timer.phases, usage, stream
+    except Exception as e:
+        return False, None, format_error(e), timer.phases, None, None
+
+def batch_documents(n):
+    """Return `n` distinct passages, so servers cannot deduplicate the batch."""
+    return [f"{i + 1}. {BATCH_PASSAGE}" for i in range(n)]
+
+def probe_batches(url, payload_for, headers, context=None, timeout=60, batch_sizes=BATCH_SIZES):
+    """POST one non-streaming request per batch size and measure how throughput scales.
+
+    `payload_for(n)` builds the request body for a batch of n items. Returns (curve, usage):
+    a list of {"batch_size", "latency", "items_per_second"} and the token usage of all the
+    requests; raises like urlopen on the first failed request.
+    """
+    curve = []
+    usage = {}
+    for n in batch_sizes:
+        req = urllib.request.Request(
+            url,
+            data=json.dumps(payload_for(n)).encode('utf-8'),
+            headers=headers,
+            method='POST'
+        )
+        timer = PhaseTimer()
+        with timed_urlopen(req, context=context, timeout=timeout, timer=timer) as response:
+            body = response.read()
+        latency = time.perf_counter() - timer.start
+        curve.append({"batch_size": n, "latency": latency, "items_per_second": n / latency})
+        usage = add_usage(usage, read_body_usage(body))
+    return curve, usage
+
+def long_context_request(context_tokens, max_tokens=LONG_GENERATION_TOKENS):
+    """Return the chat request fields for a prompt of about `context_tokens` tokens and a long answer.
+
+    The prompt repeats BATCH_PASSAGE (about 4 characters per token) after a random nonce,
+    so a server-side prefix cache cannot skip the prefill being measured.
+    """
+    repeats = max(1, context_tokens * 4 // len(BATCH_PASSAGE))
+    document = "\n\n".join([f"Reference {uuid.uuid4().hex}"] + [BATCH_PASSAGE] * repeats)
+    return {
+        "messages": [
+            {"role": "user", "content": f"{document}\n\nWrite a detailed essay of at least 2000 words about the text above."}
+        ],
+        "max_tokens": max_tokens,
+    }
+
+def probe_long_context(url, payload, headers, context=None, timeout=120, lengths=LONG_CONTEXT_LENGTHS, max_tokens=LONG_GENERATION_TOKENS):
+    """Stream one long-prompt, long-answer chat completion per context length.
+
+    `payload` is a streaming chat request whose messages and max_tokens are replaced.
+    Prefill speed is the prompt tokens over the time from sending the request to the
+    first token (so it includes queueing and one network round trip); decode speed is
+    1 / TPOT. Returns (curve, error): a list of {"context_tokens", "prompt_tokens",
+    "completion_tokens", "ttft", "total_latency", "prefill_tokens_per_second",
+    "decode_tokens_per_second"} and the error that stopped the curve, if any.
+    """
+    curve = []
+    for context_tokens in lengths:
+        request = dict(payload, **long_context_request(context_tokens, max_tokens))
+        success, ttft, error, phases, usage, stream = probe_chat_stream(url, request, headers, context=context, timeout=timeout, full_stream=True)
+        if not success:
+            return curve, error
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        prefill = phases.get("ttfb", 0) + phases.get("first_token", 0)
+        tpot = (stream or {}).get("tpot")
+        curve.append({
+            "context_tokens": context_tokens,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": usage.get("completion_tokens"),
+            "ttft": ttft,
+            "total_latency": (stream or {}).get("total_latency"),
+            "prefill_tokens_per_second": prompt_tokens / prefill if prompt_tokens and prefill > 0 else None,
+            "decode_tokens_per_second": 1 / tpot if tpot else None,
+        })
+    return curve, None
+
+def read_capability_stream(response, timer):
+    """Read a chat completion stream keeping what the canaries check; returns a dict of
+    "first" (seconds from the request start to the first "tool_call", visible "content"
+    and "reasoning" delta), "content", "reasoning" (text) and "tool_calls" ({"name",
+    "arguments"} per call) and "usage". Unlike read_chat_stream() every chunk is JSON-decoded, which
+    is fine for these short answers.
+    """
+    first = {}
+    content = []
+    reasoning = []
+    tool_calls = {}
+    usage = None
+    inline_thinking = None
+    while True:
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError("timeout: probe run deadline exceeded")
+        line = response.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            response.read()
+            break
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            continue
+        usage = chunk.get("usage") or usage
+        choices = chunk.get("choices") or []
+        delta = (choices[0].get("delta") or {}) if choices else {}
+        now = time.perf_counter() - timer.start
+        for call in delta.get("tool_calls") or []:
+            first.setdefault("tool_call", now)
+            entry = tool_calls.setdefault(call.get("index", 0), {"name": "", "arguments": ""})
+            function = call.get("function") or {}
+            entry["name"] += function.get("name") or ""
+            entry["arguments"] += function.get("arguments") or ""
+        text = delta.get("reasoning_content") or delta.get("reasoning")
+        if text:
+            first.setdefault("reasoning", now)
+            reasoning.append(text)
+        piece = delta.get("content")
+        if piece:
+            # Servers without a reasoning parser send the thinking as content, in <think> tags
+            if inline_thinking is None:
+                inline_thinking = piece.lstrip().startswith("<think>")
+            if inline_thinking:
+                first.setdefault("reasoning", now)
+                thought, closed, piece = piece.partition("</think>")
+                reasoning.append(thought)
+                inline_thinking = not closed
+            if piece.strip():
+                first.setdefault("content", now)
+            content.append(piece)
+    return {
+        "first": first,
+        "content": "".join(content).strip(),
+        "reasoning": "".join(reasoning),
+        "tool_calls": [tool_calls[i] for i in sorted(tool_calls)],
+        "usage": usage,
+    }
+
+def check_capability(capability, answer):
+    """Return why `answer` (see read_capability_stream()) is not a well-formed response
+    for `capability`, or None if it is."""
+    if capability == "tools":
+        if not answer["tool_calls"]:
+            return "no tool call in the response"
+        call = answer["tool_calls"][0]
+        if call["name"] != "get_weather":
+            return f"unexpected tool call {call['name']!r}"
+        try:
+            arguments = json.loads(call["arguments"] or "{}")
+        except ValueError:
+            return f"tool call arguments are not valid JSON: {call['arguments'][:200]}"
+        if not isinstance(arguments, dict) or not arguments.get("city"):
+            return f"tool call arguments lack the required city: {call['arguments'][:200]}"
+        return None
+    if capability == "reasoning":
+        return None if answer["reasoning"] else "no reasoning tokens in the response"
+    return None if answer["content"] else "no content in the response"
+
+def probe_capability(url, payload, headers, capability, context=None, timeout=60):
+    """Send the CANARY_REQUESTS canary of `capability` as a streaming chat completion.
+
+    `payload` is a streaming chat request whose messages and max_tokens are replaced.
+    Returns (success, first, error, usage): `first` holds the latencies in seconds to the
+    first tool-call, content and reasoning delta seen; success also requires a well-formed
+    response, see check_capability().
+    """
+    request = dict(payload, **CANARY_REQUESTS[capability])
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(request).encode('utf-8'),
+        headers=headers,
+        method='POST'
+    )
+    timer = PhaseTimer()
+    try:
+        with timed_urlopen(req, context=context, timeout=timeout, timer=timer) as response:
+            answer = read_capability_stream(response, timer)
+    except Exception as e:
+        return False, {}, format_error(e), None
+    error = check_capability(capability, answer)
+    return error is None, answer["first"], error, answer["usage"]
+
+def load_test(probe, levels=LOAD_LEVELS, requests_per_worker=4, knee_factor=2.0, max_error_rate=0.1, log=None):
+    """Ramp concurrency against one deployment and find where its latency degrades.
+
+    `probe` is a callable returning a probe_chat_stream() tuple. Each step runs
+    `requests_per_worker` requests per concurrent worker and records TTFT quantiles,
+    requests/sec and output tokens/sec. A step is degraded if its median TTFT exceeds
+    `knee_factor` times the median at the first step or more than `max_error_rate` of
+    its requests fail; the ramp stops there, so a saturated supplier is not pushed
+    further. Returns {"steps", "knee", "degraded_at"}, where knee is the highest healthy
+    concurrency (None if even the first step was degraded).
+    """
+    steps = []
+    baseline = None
+    knee = None
+    degraded_at = None
+    for concurrency in levels:
+        total = concurrency * requests_per_worker
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(lambda _: probe(), range(total)))
+        elapsed = time.perf_counter() - start
+
+        ttfts = [o[1] for o in outcomes if o[0]]
+        errors = [o[2] for o in outcomes if not o[0]]
+        tokens = sum((o[4] or {}).get('completion_tokens') or 0 for o in outcomes if o[0])
+        ttft_quantiles = quantiles(ttfts, (0.5, 0.9))
+        step = {
+            "concurrency": concurrency,
+            "requests": total,
+            "errors": len(errors),
+            "ttft_p50": ttft_quantiles[0.5] if ttfts else None,
+            "ttft_p90": ttft_quantiles[0.9] if ttfts else None,
+            "requests_per_second": len(ttfts) / elapsed,
+            "output_tokens_per_second": tokens / elapsed,
+            "duration": elapsed,
+            "first_error": errors[0] if errors else None,
+        }
+        steps.append(step)
+        if log:
+            log(f"  concurrency {concurrency:>3}: {len(ttfts)}/{total} ok, TTFT p50 {step['ttft_p50'] or math.nan:.3f}s "
+                f"p90 {step['ttft_p90'] or math.nan:.3f}s, {step['requests_per_second']:.2f} req/s, "
+                f"{step['output_tokens_per_second']:.1f} tok/s")
+
+        if baseline is None and ttfts:
+            baseline = step["ttft_p50"]
+        if (len(errors) > max_error_rate * total or not ttfts
+                or step["ttft_p50"] > knee_factor * baseline):
+            degraded_at = concurrency
+            break
+        knee = concurrency
+    return {"steps": steps, "knee": knee, "degraded_at": degraded_at}
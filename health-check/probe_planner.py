@@ -0,0 +1,88 @@
+import math
+
+def _severity(result):
+    """Order results from best to worst: fast success < slow success < failure."""
+    if not result.get("success", False):
+        return (1, 0.0)
+    return (0, result.get("ttft") or 0.0)
+
+class ProbePlanner:
+    """Decide when each (family, model) is next due for a probe.
+
+    Healthy models back off geometrically towards `max_interval`; failed models are
+    retried at `min_interval`, doubling with each further consecutive failure up to
+    `base_interval` (the rate of a fixed hourly schedule), and slow ones (TTFT above `slow_factor` times their own
+    median) at a quarter of `base_interval`. Intervals are then shortened for models
+    that carry more routing weight, so busy models are checked more often.
+    """
+
+    def __init__(self, base_interval=3600, min_interval=300, max_interval=14400, slow_factor=2.0, backoff_after=3):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.slow_factor = slow_factor
+        self.backoff_after = backoff_after
+        self.entries = {}  # (family, model) -> {"next_due", "interval", "healthy_streak", "failure_streak", "state"}
+        self.weights = {}  # lowercased model name -> total routing weight across deployments
+
+    def set_weights(self, weights):
+        self.weights = {name.lower(): w for name, w in weights.items() if w and w > 0}
+
+    def weight_factor(self, model):
+        weight = self.weights.get(model.lower(), 1)
+        return 1 + math.log2(max(weight, 1))
+
+    def observe(self, family, result, baseline, now):
+        """Update the schedule from one probe result; `baseline` is the model's median TTFT or None."""
+        model = result.get("model", "")
+        entry = self.entries.setdefault((family, model), {"healthy_streak": 0, "failure_streak": 0})
+        ttft = result.get("ttft")
+
+        if not result.get("success", False):
+            entry["state"] = "failing"
+            entry["healthy_streak"] = 0
+            entry["failure_streak"] += 1
+            interval = min(self.min_interval * 2 ** min(entry["failure_streak"] - 1, 16), self.base_interval)
+        elif baseline and ttft is not None and ttft > self.slow_factor * baseline:
+            entry["state"] = "slow"
+            entry["healthy_streak"] = 0
+            entry["failure_streak"] = 0
+            interval = self.base_interval / 4
+        else:
+            entry["state"] = "healthy"
+            entry["healthy_streak"] += 1
+            entry["failure_streak"] = 0
+            doublings = entry["healthy_streak"] // self.backoff_after
+            interval = self.base_interval * (2 ** min(doublings, 8))
+
+        interval = interval / self.weight_factor(model)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        entry["interval"] = interval
+        entry["next_due"] = now + interval
+
+    def observe_run(self, family, results, baselines, now):
+        """Observe a family run; models with several deployments are scheduled by their worst result,
+        judged against that deployment's baseline in `baselines` ((model, api_base) -> median TTFT)."""
+        worst = {}
+        for r in results:
+            model = r.get("model", "")
+            current = worst.get(model)
+            if current is None or _severity(r) > _severity(current):
+                worst[model] = r
+        for model, r in worst.items():
+            self.observe(family, r, baselines.get((model, r.get("api_base", ""))), now)
+
+    def due(self, family, models, now):
+        """Return the models of `family` whose next probe is due, never-probed models included."""
+        due = []
+        for model in models:
+            entry = self.entries.get((family, model))
+            if entry is None or entry["next_due"] <= now:
+                due.append(model)
+        return due
+
+    def forget(self, family, keep):
+        """Drop schedule entries for models of `family` that are no longer in `keep`."""
+        keep = set(keep)
+        for key in [k for k in self.entries if k[0] == family and k[1] not in keep]:
+            del self.entries[key]
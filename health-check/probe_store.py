@@ -0,0 +1,152 @@
+import os
+import math
+import mmap
+import struct
+import threading
+
+# File layout: a fixed header followed by `capacity` fixed-size records used as a ring.
+# Records are appended in time order, so the live window is always sorted by timestamp.
+MAGIC = b"HCPH"
+VERSION = 2
+HEADER = struct.Struct("<4sIIQ")  # magic, version, capacity, records written (monotonic)
+HEADER_SIZE = 64
+RECORD = struct.Struct("<dd?23s128s96s")  # timestamp, ttft (NaN if none), success, family, model, api_base (suppliers)
+TIMESTAMP = struct.Struct("<d")
+
+class ProbeStore:
+    """Append-only time series of probe results in a fixed-size memory-mapped ring file."""
+
+    def __init__(self, path, capacity=65536):
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+
+        size = HEADER_SIZE + capacity * RECORD.size
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, version, file_capacity, written = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION or file_capacity != capacity:
+            written = 0
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, capacity, written)
+        self.written = written
+
+    def _offset(self, seq):
+        return HEADER_SIZE + (seq % self.capacity) * RECORD.size
+
+    def _first_seq(self):
+        return max(0, self.written - self.capacity)
+
+    def _decode(self, seq):
+        return self._record(RECORD.unpack_from(self.mm, self._offset(seq)))
+
+    def _record(self, fields):
+        timestamp, ttft, success, family, model, api_base = fields
+        return {
+            "family": family.rstrip(b"\0").decode("utf-8", "replace"),
+            "model": model.rstrip(b"\0").decode("utf-8", "replace"),
+            "api_base": api_base.rstrip(b"\0").decode("utf-8", "replace"),
+            "timestamp": timestamp,
+            "success": success,
+            "ttft": None if math.isnan(ttft) else ttft,
+        }
+
+    def append_run(self, family, timestamp, results):
+        """Record every result of one family run under the same run timestamp.
+
+        Runs finish concurrently (scheduler, correlated and on-demand probes), so a run may
+        arrive after a later one; it is then stamped with the latest timestamp in the file,
+        keeping the records sorted for query()'s binary search.
+        """
+        family_bytes = family.encode("utf-8")
+        with self.lock:
+            if self.written:
+                timestamp = max(timestamp, TIMESTAMP.unpack_from(self.mm, self._offset(self.written - 1))[0])
+            for r in results:
+                ttft = r.get("ttft")
+                RECORD.pack_into(
+                    self.mm, self._offset(self.written),
+                    timestamp,
+                    math.nan if ttft is None else ttft,
+                    bool(r.get("success", False)),
+                    family_bytes,
+                    r.get("model", "").encode("utf-8"),
+                    r.get("api_base", "").encode("utf-8"),
+                )
+                self.written += 1
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.capacity, self.written)
+            self.mm.flush()
+
+    def query(self, family=None, model=None, since=0.0, limit=None):
+        """Yield up to `limit` records newer than `since`, oldest first, decoding only the ones that match."""
+        family_bytes = family.encode("utf-8") if family else None
+        model_bytes = model.encode("utf-8") if model else None
+        with self.lock:
+            end = self.written
+            # Binary search the first record at or after `since`
+            lo, hi = self._first_seq(), end
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if TIMESTAMP.unpack_from(self.mm, self._offset(mid))[0] < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        # Each record is read under the lock, which is not held while the caller consumes it;
+        # records the ring overwrote since the query started are skipped
+        yielded = 0
+        for seq in range(lo, end):
+            if limit is not None and yielded >= limit:
+                return
+            with self.lock:
+                if seq < self._first_seq():
+                    continue
+                fields = RECORD.unpack_from(self.mm, self._offset(seq))
+            if family_bytes and fields[3].rstrip(b"\0") != family_bytes:
+                continue
+            if model_bytes and fields[4].rstrip(b"\0") != model_bytes:
+                continue
+            yielded += 1
+            yield self._record(fields)
+
+    def last_runs(self, window=0.0):
+        """Return {family: (timestamp, results)} with each model's (or supplier endpoint's) latest result.
+
+        Only models probed within `window` seconds of the family's newest record are
+        included; with the default of 0 that is exactly the most recent run.
+        """
+        runs = {}
+        seen = set()
+        with self.lock:
+            for seq in range(self.written - 1, self._first_seq() - 1, -1):
+                rec = self._decode(seq)
+                run = runs.get(rec["family"])
+                if run is None:
+                    run = runs[rec["family"]] = (rec["timestamp"], [])
+                elif rec["timestamp"] < run[0] - window:
+                    continue
+                series = (rec["family"], rec["model"], rec["api_base"])
+                key = series + (rec["timestamp"],)
+                if series in seen and key not in seen:
+                    continue
+                seen.add(series)
+                seen.add(key)
+                run[1].append({
+                    "model": rec["model"],
+                    "api_base": rec["api_base"],
+                    "success": rec["success"],
+                    "ttft": rec["ttft"],
+                    "error": None,
+                })
+        for _, results in runs.values():
+            results.reverse()
+        return runs
+
+    def close(self):
+        self.mm.close()
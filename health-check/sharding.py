@@ -0,0 +1,195 @@
+import os
+import ssl
+import json
+import bisect
+import socket
+import hashlib
+import urllib.parse
+
+# Points per replica on the hash ring; more points even out the share of each replica
+VIRTUAL_NODES = 128
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hash ring assigning models to replicas.
+
+    A model is placed by its lowercased name, so its paths in every family (Hugging Face,
+    Zuplo, LiteLLM, suppliers) land on the same replica and the correlated probes still see
+    them together. When a replica joins or leaves only the models next to its points move.
+    """
+
+    def __init__(self, members, vnodes=VIRTUAL_NODES):
+        self.members = tuple(sorted(set(members)))
+        points = sorted((_hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.owners = [member for _, member in points]
+
+    def owner(self, model):
+        """Return the replica that owns `model`, or None if the ring is empty."""
+        if not self.owners:
+            return None
+        i = bisect.bisect(self.hashes, _hash(model.lower())) % len(self.hashes)
+        return self.owners[i]
+
+def shard_filter(replica, members):
+    """Predicate for the probe scripts' --shard/--shard-members options: does `replica` own a model?"""
+    ring = HashRing(members.split(","))
+    return lambda model: ring.owner(model) == replica
+
+class FileLeases:
+    """Leases as files in a directory shared by the replicas (e.g. a ReadWriteMany volume).
+
+    Each replica keeps `<replica>.lease` holding its expiry time; expired leases are
+    removed by whichever replica lists the members next.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def renew(self, replica, ttl, now):
+        path = os.path.join(self.path, f"{replica}.lease")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"replica": replica, "expires": now + ttl}, f)
+        os.replace(tmp_path, path)
+
+    def members(self, now):
+        members = []
+        for file in os.listdir(self.path):
+            if not file.endswith(".lease"):
+                continue
+            path = os.path.join(self.path, file)
+            try:
+                with open(path, "r") as f:
+                    lease = json.load(f)
+                if lease["expires"] > now:
+                    members.append(lease["replica"])
+                    continue
+                os.remove(path)
+            except (OSError, ValueError, KeyError):
+                pass
+        return members
+
+    def release(self, replica):
+        try:
+            os.remove(os.path.join(self.path, f"{replica}.lease"))
+        except FileNotFoundError:
+            pass
+
+class RedisLeases:
+    """Leases as Redis keys `<prefix><replica>` that expire after the lease TTL.
+
+    Speaks just enough of the Redis protocol (AUTH, SELECT, SET, SCAN, DEL) over one
+    short-lived connection per call, as leases are only renewed every few seconds.
+    """
+
+    def __init__(self, url, prefix="health-check:lease:", timeout=5):
+        url = urllib.parse.urlsplit(url)
+        self.address = (url.hostname or "localhost", url.port or 6379)
+        self.username = urllib.parse.unquote(url.username) if url.username else None
+        self.password = urllib.parse.unquote(url.password) if url.password else None
+        self.db = int(url.path.lstrip("/") or 0)
+        self.tls = url.scheme == "rediss"
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def _call(self, *commands):
+        """Send `commands` (tuples of arguments) in one round trip and return their replies."""
+        setup = []
+        if self.password is not None:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", str(self.db)))
+        payload = b""
+        for command in setup + list(commands):
+            payload += b"*%d\r\n" % len(command)
+            for arg in command:
+                arg = str(arg).encode("utf-8")
+                payload += b"$%d\r\n%s\r\n" % (len(arg), arg)
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        try:
+            if self.tls:
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.address[0])
+            sock.sendall(payload)
+            with sock.makefile("rb") as reader:
+                replies = [self._read(reader) for _ in range(len(setup) + len(commands))]
+        finally:
+            sock.close()
+        return replies[len(setup):]
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by Redis")
+        kind, value = line[:1], line[1:-2]
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {value.decode('utf-8', 'replace')}")
+        if kind == b"+":
+            return value.decode("utf-8")
+        if kind == b":":
+            return int(value)
+        if kind == b"$":
+            if int(value) < 0:
+                return None
+            data = reader.read(int(value) + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            return [self._read(reader) for _ in range(max(int(value), 0))]
+        raise RuntimeError(f"unexpected Redis reply: {line[:64]!r}")
+
+    def renew(self, replica, ttl, now):
+        self._call(("SET", self.prefix + replica, now + ttl, "PX", max(int(ttl * 1000), 1)))
+
+    def members(self, now):
+        members = []
+        cursor = "0"
+        while True:
+            cursor, keys = self._call(("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 1000))[0]
+            members.extend(key[len(self.prefix):] for key in keys)
+            if cursor == "0":
+                return members
+
+    def release(self, replica):
+        self._call(("DEL", self.prefix + replica))
+
+def open_leases(url):
+    """Return the lease store of `url`: redis:// or rediss:// for Redis, a directory path (or file://) otherwise."""
+    scheme = urllib.parse.urlsplit(url).scheme
+    if scheme in ("redis", "rediss"):
+        return RedisLeases(url)
+    if scheme == "file":
+        return FileLeases(urllib.parse.urlsplit(url).path)
+    return FileLeases(url)
+
+class Membership:
+    """This replica's lease and its view of the replicas holding one.
+
+    The caller renews every `ttl / 3` seconds or so; a replica that stops renewing drops out
+    of the others' rings once its lease expires, and its models move to them.
+    """
+
+    def __init__(self, leases, replica, ttl):
+        self.leases = leases
+        self.replica = replica
+        self.ttl = ttl
+        self.ring = HashRing([replica])
+        self.renewed = False
+
+    def renew(self, now):
+        """Renew the lease and rebuild the ring; returns True on the first renewal and when the members changed."""
+        self.leases.renew(self.replica, self.ttl, now)
+        members = set(self.leases.members(now)) | {self.replica}
+        if self.renewed and tuple(sorted(members)) == self.ring.members:
+            return False
+        self.ring = HashRing(members)
+        self.renewed = True
+        return True
+
+    def owns(self, model):
+        return self.ring.owner(model) == self.replica
+
+    def release(self):
+        self.leases.release(self.replica)
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 import os
 import re
-import ssl
 import sys
-import time
 import json
+import random
 import argparse
-import urllib.request
-import urllib.error
+import urllib.parse
+import functools
+import contextlib
+
+from model_catalog import checkout_lock, find_models_dir, load_endpoints, sync_checkout
+from probe_engine import FULL_STREAM_REQUEST, LOAD_LEVELS, LONG_CONTEXT_LENGTHS, LONG_GENERATION_TOKENS, connection_state, load_test, probe_capability, probe_chat_stream, probe_long_context, run_probes, set_deadline, ssl_context
+from sharding import shard_filter
 
 def load_env(env_path, verbose=True):
     """Load environment variables from a .env file."""
@@ -26,41 +30,6 @@ def load_env(env_path, verbose=True):
                 val = val.strip().strip('"').strip("'")
                 os.environ[key] = val
 
-def parse_active_endpoints(models_dir, verbose=True):
-    """Parse active LLM endpoints from the litellm models directory."""
-    import yaml
-    if not os.path.exists(models_dir):
-        raise FileNotFoundError(f"models directory not found at {models_dir}")
-        
-    models = []
-    
-    for root_dir, _, files in sorted(os.walk(models_dir)):
-        for file in sorted(files):
-            if file.endswith('.yaml') or file.endswith('.yml'):
-                file_path = os.path.join(root_dir, file)
-                try:
-                    with open(file_path, 'r') as f:
-                        data = yaml.safe_load(f)
-                    if not data or 'models' not in data:
-                        continue
-                    for m in data['models']:
-                        model_name = m.get('model_name')
-                        if not model_name:
-                            continue
-                        litellm_params = m.get('litellm_params', {})
-                        # Only test endpoints that have api_base
-                        if 'api_base' in litellm_params:
-                            models.append({
-                                'model_name': model_name,
-                                'litellm_params': litellm_params
-                            })
-                except Exception as e:
-                    if verbose:
-                        print(f"Error parsing model file {file_path}: {e}", file=sys.stderr)
-                    
-    return models
-
-
 def resolve_api_key(api_key_str):
     """Resolve API key which may refer to an environment variable."""
     if not api_key_str:
@@ -70,8 +39,11 @@ def resolve_api_key(api_key_str):
         return os.environ.get(env_var, "")
     return api_key_str
 
-def measure_ttft(model_name, litellm_model, api_base, api_key_str, ssl_verify=True):
-    """Call the LLM endpoint and measure Time to First Token (TTFT) with a 30s timeout."""
+def build_request(litellm_model, api_base, api_key_str, ssl_verify=True, full_stream=False):
+    """Build the streaming chat completion probe for one endpoint.
+
+    Returns (url, payload, headers, context) for probe_chat_stream().
+    """
     api_key = resolve_api_key(api_key_str)
     
     # Strip OpenAI provider prefix if present
@@ -87,8 +59,11 @@ def measure_ttft(model_name, litellm_model, api_base, api_key_str, ssl_verify=Tr
             {"role": "user", "content": "Respond with a single word hello"}
         ],
         "stream": True,
+        "stream_options": {"include_usage": True},
         "max_tokens": 10
     }
+    if full_stream:
+        payload.update(FULL_STREAM_REQUEST)
     
     headers = {
         "Content-Type": "application/json",
@@ -97,65 +72,97 @@ def measure_ttft(model_name, litellm_model, api_base, api_key_str, ssl_verify=Tr
     if api_key:
         headers["Authorization"] = f"Bearer {api_key}"
         
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(payload).encode('utf-8'),
-        headers=headers,
-        method='POST'
-    )
-    
-    # SSL context creation
-    if not ssl_verify:
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-    else:
-        context = None
+    context = ssl_context(ssl_verify)
         
-    t0 = time.time()
-    try:
-        # Establish connection and send request with 30s timeout
-        with urllib.request.urlopen(req, context=context, timeout=30) as response:
-            # Read streaming response line by line to get the first token
-            while True:
-                line = response.readline()
-                if not line:
-                    break
-                line_str = line.decode('utf-8').strip()
-                if line_str.startswith('data:'):
-                    data_str = line_str[5:].strip()
-                    if data_str == '[DONE]':
-                        break
-                    try:
-                        data = json.loads(data_str)
-                        choices = data.get('choices', [])
-                        if choices:
-                            delta = choices[0].get('delta', {})
-                            # Check for any generated content/token
-                            if delta.get('content') or delta.get('reasoning_content') or delta.get('text') or delta:
-                                ttft = time.time() - t0
-                                return True, ttft, None
-                    except json.JSONDecodeError:
-                        pass
-                        
-            return False, None, "Response finished without returning any tokens"
-            
-    except urllib.error.HTTPError as e:
-        # Try to read the error body for more details
-        try:
-            error_body = e.read().decode('utf-8')
-            return False, None, f"HTTP Error {e.code}: {e.reason} - Details: {error_body}"
-        except Exception:
-            return False, None, f"HTTP Error {e.code}: {e.reason}"
-    except urllib.error.URLError as e:
-        return False, None, f"URL Error: {e.reason}"
-    except Exception as e:
-        return False, None, f"Exception: {type(e).__name__} - {str(e)}"
+    return url, payload, headers, context
+
+def measure_ttft(model_name, litellm_model, api_base, api_key_str, ssl_verify=True, full_stream=False):
+    """Call the LLM endpoint and measure Time to First Token (TTFT) with a 30s timeout.
+
+    Returns (success, ttft, error, phases, usage, stream) where phases holds the per-phase
+    timings, usage the token usage reported at the end of the stream and stream the
+    decode stats of a full-stream probe (None otherwise).
+    """
+    url, payload, headers, context = build_request(litellm_model, api_base, api_key_str, ssl_verify, full_stream)
+    return probe_chat_stream(url, payload, headers, context=context, timeout=30, full_stream=full_stream)
+
+def load_test_endpoint(ep, ssl_verify, levels, requests_per_worker, knee_factor, log):
+    """Ramp concurrency against one endpoint; see probe_engine.load_test()."""
+    params = ep['litellm_params']
+    # Ask for a longer answer so the decode throughput of the deployment is exercised too
+    url, payload, headers, context = build_request(params.get('model', ''), params.get('api_base', ''), params.get('api_key', ''), ssl_verify, full_stream=True)
+    return load_test(
+        lambda: probe_chat_stream(url, payload, headers, context=context, timeout=30),
+        levels=levels,
+        requests_per_worker=requests_per_worker,
+        knee_factor=knee_factor,
+        log=log
+    )
+
+def endpoint_result(ep, **fields):
+    """Result of one endpoint: its model, api_base and weight, plus `fields`."""
+    params = ep['litellm_params']
+    return {
+        'model': ep['model_name'],
+        'model_name': ep['model_name'],
+        'api_base': params.get('api_base', ''),
+        'weight': params.get('weight', 1),
+        **fields
+    }
+
+def endpoint_ssl_verify(ep):
+    ssl_verify_val = ep['litellm_params'].get('ssl_verify', True)
+    if isinstance(ssl_verify_val, str):
+        return ssl_verify_val.strip().lower() != 'false'
+    return bool(ssl_verify_val)
+
+def endpoint_capabilities(ep):
+    """Return the capability canaries (see probe_engine.CANARY_REQUESTS) that apply to an endpoint.
+
+    Vision needs supports_vision; reasoning supports_reasoning or a -thinking model; tool
+    calling supports_function_calling, or an Apertus model (served with the apertus_json
+    tool parser).
+    """
+    params = ep['litellm_params']
+
+    def flag(name):
+        value = params.get(name, False)
+        if isinstance(value, str):
+            return value.strip().lower() == 'true'
+        return bool(value)
+
+    name = ep['model_name'].lower()
+    capabilities = []
+    if flag('supports_function_calling') or 'apertus' in name:
+        capabilities.append('tools')
+    if flag('supports_vision'):
+        capabilities.append('vision')
+    if flag('supports_reasoning') or name.endswith('-thinking'):
+        capabilities.append('reasoning')
+    return capabilities
 
 def main():
     parser = argparse.ArgumentParser(description="Test Provider endpoints")
+    parser.add_argument("--models", help="Comma-separated list of model names to test (default: all)")
+    parser.add_argument("--shard", help="Only probe the models this replica owns on the hash ring of --shard-members (see sharding.py)")
+    parser.add_argument("--shard-members", default="", help="Comma-separated replicas sharing the models, with --shard")
+    parser.add_argument("--full-stream", action="store_true", help="Read every stream to the end and report decode speed")
+    parser.add_argument("--workers", type=int, default=8, help="Number of parallel workers to use")
+    parser.add_argument("--per-host", type=int, default=2, help="Maximum simultaneous probes against one provider host")
+    parser.add_argument("--load", action="store_true", help="Load-test the selected endpoints one at a time instead of probing them (requires --models)")
+    parser.add_argument("--load-levels", default=",".join(map(str, LOAD_LEVELS)), help="Comma-separated concurrency steps of the load test")
+    parser.add_argument("--load-requests", type=int, default=4, help="Requests per concurrent worker at each load step")
+    parser.add_argument("--knee-factor", type=float, default=2.0, help="Median TTFT growth over the first step that counts as degraded")
+    parser.add_argument("--long-context", action="store_true", help="Measure prefill and decode speed with long prompts and long answers instead of probing TTFT")
+    parser.add_argument("--context-lengths", default=",".join(map(str, LONG_CONTEXT_LENGTHS)), help="Comma-separated prompt sizes in tokens of the long-context probes")
+    parser.add_argument("--long-max-tokens", type=int, default=LONG_GENERATION_TOKENS, help="Answer length in tokens requested by each long-context probe")
+    parser.add_argument("--long-timeout", type=float, default=120, help="Seconds one long-context request may take")
+    parser.add_argument("--token-budget", type=int, default=0, help="Most tokens (prompt + answer) one long-context run may spend; endpoints beyond it are skipped (0: no limit)")
+    parser.add_argument("--canaries", action="store_true", help="Send the tool-call, vision and reasoning canaries to the endpoints that support them instead of probing TTFT")
+    parser.add_argument("--deadline", type=float, default=0, help="Seconds the whole run may take; unfinished probes are reported as timeout (0: no limit)")
     parser.add_argument("-json", "--json", action="store_true", help="Output results in JSON format")
     args = parser.parse_args()
+    set_deadline(args.deadline)
     
     json_mode = args.json
     
@@ -176,91 +183,199 @@ def main():
             
         env_path = os.path.join(root_dir, '.env')
         
-        models_dir = os.environ.get("MODELS_DIR")
-        if not models_dir:
-            try:
-                import shutil
-                import subprocess
-                repo_dir = "/tmp/chat.publicai.co"
-                if os.path.exists(repo_dir):
-                    try:
-                        shutil.rmtree(repo_dir)
-                    except Exception:
-                        pass
-                log("Cloning latest models dynamically from public repository...")
-                subprocess.run(
-                    ["git", "clone", "--depth", "1", "https://github.com/forpublicai/chat.publicai.co.git", repo_dir],
-                    check=True,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL
-                )
-                models_dir = os.path.join(repo_dir, 'charts/web_services/charts/litellm/models')
-            except Exception as e:
-                log(f"Dynamic clone failed: {e}. Falling back to local directory.")
-                models_dir = os.path.join(root_dir, 'charts/web_services/charts/litellm/models')
-        
         log(f"Loading environment from: {env_path}")
         load_env(env_path, verbose=not json_mode)
         
-        log(f"Parsing active endpoints from: {models_dir}")
-        active_endpoints = parse_active_endpoints(models_dir, verbose=not json_mode)
+        # MODELS_DIR points at a local or mounted (e.g. ConfigMap) copy of the model files;
+        # otherwise a sparse checkout of the public repository is kept up to date, under a
+        # lock so concurrent runs never read it while another one resets it
+        models_dir = os.environ.get("MODELS_DIR")
+        checkout_dir = os.environ.get("CATALOG_CHECKOUT_DIR", "/tmp/chat.publicai.co")
+        index_path = os.environ.get("CATALOG_INDEX_PATH", "/tmp/chat.publicai.co-models.json")
+        with contextlib.nullcontext() if models_dir else checkout_lock(checkout_dir):
+            if not models_dir:
+                try:
+                    models_dir = sync_checkout(checkout_dir, log=log)
+                except Exception as e:
+                    log(f"Model catalog sync failed: {e}. Falling back to local directory.")
+                    models_dir = find_models_dir(root_dir)
+            
+            log(f"Loading active endpoints from: {models_dir}")
+            active_endpoints = load_endpoints(models_dir, index_path, verbose=not json_mode)
         
         if not active_endpoints:
             raise RuntimeError("No active HTTP endpoints found in models directory.")
             
-        log(f"Found {len(active_endpoints)} active HTTP endpoints. Starting tests...")
+        if args.models:
+            wanted = set(args.models.split(","))
+            active_endpoints = [ep for ep in active_endpoints if ep['model_name'] in wanted]
+        if args.shard:
+            owns = shard_filter(args.shard, args.shard_members)
+            active_endpoints = [ep for ep in active_endpoints if owns(ep['model_name'])]
+            
+        if args.load:
+            if not args.models:
+                raise ValueError("--load requires --models, so production suppliers are never load-tested by accident.")
+            levels = [int(level) for level in args.load_levels.split(",")]
+            load_results = []
+            for ep in active_endpoints:
+                api_base = ep['litellm_params'].get('api_base', '')
+                log(f"Load testing {ep['model_name']} at {api_base} (weight {ep['litellm_params'].get('weight', 1)})...")
+                load = load_test_endpoint(ep, endpoint_ssl_verify(ep), levels, args.load_requests, args.knee_factor, log)
+                log(f"  knee: {load['knee']} concurrent requests" + (f", degraded at {load['degraded_at']}" if load['degraded_at'] else ", not reached"))
+                load_results.append({
+                    'model': ep['model_name'],
+                    'model_name': ep['model_name'],
+                    'api_base': api_base,
+                    'weight': ep['litellm_params'].get('weight', 1),
+                    'load': load
+                })
+            if json_mode:
+                print(json.dumps({"success": True, "error": None, "results": load_results}, indent=2))
+            sys.exit(0)
+            
+        log(f"Found {len(active_endpoints)} active HTTP endpoints. Testing with {args.workers} workers, at most {args.per_host} per host...")
         log("-" * 120)
         
-        results = []
-        for idx, ep in enumerate(active_endpoints, 1):
+        # Probes are scheduled per provider host (see run_probes), so a slow or hung provider
+        # only ties up its own slots. Long-context probes go one at a time per host, so they do
+        # not skew each other's speed
+        def endpoint_host(ep):
+            return urllib.parse.urlsplit(ep['litellm_params'].get('api_base', '')).netloc.lower()
+        per_host = 1 if args.long_context else max(args.per_host, 1)
+
+        def run_endpoint_probes(endpoints, probe, failed_fields):
+            """Run probe(idx, ep) for every endpoint and return the results in endpoint order.
+
+            A probe that raised or missed the run deadline is reported as a failed result
+            with the fields of failed_fields(ep, error).
+            """
+            tasks = [functools.partial(probe, idx, ep) for idx, ep in enumerate(endpoints, 1)]
+            outcomes = run_probes(tasks, args.workers, keys=[endpoint_host(ep) for ep in endpoints], per_key=per_host)
+            results = []
+            for idx, (ep, (status, value)) in enumerate(zip(endpoints, outcomes), 1):
+                if status != "done":
+                    if status == "error":
+                        log(f"[{idx}/{len(endpoints)}] {ep['model_name']}: FAILED (Exception: {value})")
+                        error = f"Thread Exception: {value}"
+                    else:
+                        log(f"[{idx}/{len(endpoints)}] {ep['model_name']}: TIMEOUT (run deadline of {args.deadline:g}s reached)")
+                        error = f"timeout: probe did not finish within the {args.deadline:g}s run deadline"
+                    value = endpoint_result(ep, success=False, error=error, **failed_fields(ep, error))
+                results.append(value)
+            return results
+
+        def report(results, failure_message):
+            """In JSON mode print the run's output and exit (1 if any result failed); otherwise return the failures."""
+            failures = [r for r in results if not r['success']]
+            if json_mode:
+                err_obj = None
+                if failures:
+                    err_msgs = [f"{f['model_name']}: {f['error']}" for f in failures]
+                    err_obj = {
+                        "message": f"{len(failures)} {failure_message}: {', '.join(err_msgs)}",
+                        "code": "MODEL_TESTS_FAILED"
+                    }
+                print(json.dumps({"success": not failures, "error": err_obj, "results": results}, indent=2))
+                sys.exit(1 if failures else 0)
+            return failures
+
+        if args.canaries:
+            def canary_endpoint(idx, ep):
+                params = ep['litellm_params']
+                api_base = params.get('api_base', '')
+                url, payload, headers, context = build_request(params.get('model', ''), api_base, params.get('api_key', ''), endpoint_ssl_verify(ep))
+                canaries = {}
+                usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+                for capability in endpoint_capabilities(ep):
+                    success, first, error, canary_usage = probe_capability(url, payload, headers, capability, context=context)
+                    firsts = ", ".join(f"first {kind} {seconds:.3f}s" for kind, seconds in first.items())
+                    log(f"[{idx}] {ep['model_name']} {capability}: {'OK' if success else 'FAILED'}" + (f" ({firsts})" if firsts else "") + (f" - {error}" if error else ""))
+                    canaries[capability] = {'success': success, 'first': first, 'error': error}
+                    for key in usage:
+                        usage[key] += (canary_usage or {}).get(key) or 0
+                failed = [f"{capability}: {c['error']}" for capability, c in canaries.items() if not c['success']]
+                return endpoint_result(ep, success=not failed, canaries=canaries, usage=usage, error="; ".join(failed) or None)
+
+            def canaries_failed(ep, error):
+                return {'canaries': {capability: {'success': False, 'first': {}, 'error': error} for capability in endpoint_capabilities(ep)}}
+
+            targets = [ep for ep in active_endpoints if endpoint_capabilities(ep)]
+            log(f"Sending capability canaries to {len(targets)} endpoints...")
+            failures = report(run_endpoint_probes(targets, canary_endpoint, canaries_failed), "endpoint(s) failed capability canaries")
+            sys.exit(1 if failures else 0)
+
+        if args.long_context:
+            lengths = [int(n) for n in args.context_lengths.split(",")]
+            cost = sum(lengths) + len(lengths) * args.long_max_tokens
+            # Shuffled, so a budget too small for every endpoint still covers all of them over several runs
+            random.shuffle(active_endpoints)
+            if args.deadline:
+                # A host's endpoints are probed one after another, so only as many as can finish
+                # within the deadline at --long-timeout per request are taken from each host
+                fit = max(int(args.deadline // (len(lengths) * args.long_timeout)), 1)
+                taken = {}
+                selected = []
+                for ep in active_endpoints:
+                    host = endpoint_host(ep)
+                    if taken.get(host, 0) < fit:
+                        taken[host] = taken.get(host, 0) + 1
+                        selected.append(ep)
+                if len(selected) < len(active_endpoints):
+                    log(f"Deadline of {args.deadline:g}s covers {fit} endpoints per host; probing {len(selected)} of {len(active_endpoints)}")
+                    active_endpoints = selected
+            if args.token_budget and args.token_budget // cost < len(active_endpoints):
+                log(f"Token budget of {args.token_budget} covers {args.token_budget // cost} of {len(active_endpoints)} endpoints at {cost} tokens each")
+                active_endpoints = active_endpoints[:args.token_budget // cost]
+
+            def long_context_endpoint(idx, ep):
+                params = ep['litellm_params']
+                api_base = params.get('api_base', '')
+                url, payload, headers, context = build_request(params.get('model', ''), api_base, params.get('api_key', ''), endpoint_ssl_verify(ep))
+                log(f"[{idx}/{len(active_endpoints)}] Long-context probe of {ep['model_name']} at {api_base} ...")
+                curve, error = probe_long_context(url, payload, headers, context=context, timeout=args.long_timeout, lengths=lengths, max_tokens=args.long_max_tokens)
+                for point in curve:
+                    log(f"  {ep['model_name']} @ {point['context_tokens']} tokens: TTFT {point['ttft']:.2f}s, prefill {point['prefill_tokens_per_second'] or 0:.0f} tok/s, decode {point['decode_tokens_per_second'] or 0:.1f} tok/s")
+                if error:
+                    log(f"{ep['model_name']} at {api_base}: FAILED ({error})")
+                return endpoint_result(
+                    ep,
+                    success=error is None,
+                    long_context=curve,
+                    usage={
+                        'prompt_tokens': sum(p['prompt_tokens'] or 0 for p in curve),
+                        'completion_tokens': sum(p['completion_tokens'] or 0 for p in curve),
+                    },
+                    error=error
+                )
+
+            results = run_endpoint_probes(active_endpoints, long_context_endpoint, lambda ep, error: {'long_context': []})
+            failures = report(results, "long-context probe(s) failed")
+            sys.exit(1 if failures else 0)
+        
+        def test_single_endpoint(idx, ep):
             model_name = ep['model_name']
             litellm_model = ep['litellm_params'].get('model', '')
             api_base = ep['litellm_params'].get('api_base', '')
             api_key_str = ep['litellm_params'].get('api_key', '')
-            
-            ssl_verify_val = ep['litellm_params'].get('ssl_verify', True)
-            if isinstance(ssl_verify_val, str):
-                ssl_verify = ssl_verify_val.strip().lower() != 'false'
-            else:
-                ssl_verify = bool(ssl_verify_val)
+            ssl_verify = endpoint_ssl_verify(ep)
             
             log(f"[{idx}/{len(active_endpoints)}] Testing model: {model_name} at {api_base} ...")
-            success, ttft, error = measure_ttft(model_name, litellm_model, api_base, api_key_str, ssl_verify)
+            success, ttft, error, phases, usage, stream = measure_ttft(model_name, litellm_model, api_base, api_key_str, ssl_verify, args.full_stream)
             
-            results.append({
-                'model': model_name,
-                'model_name': model_name,
-                'api_base': api_base,
-                'success': success,
-                'ttft': ttft,
-                'error': error
-            })
-            
-        failures = [r for r in results if not r['success']]
+            return endpoint_result(
+                ep,
+                success=success,
+                ttft=ttft,
+                phases=phases,
+                connection=connection_state(phases),
+                usage=usage,
+                stream=stream,
+                error=error
+            )
         
-        if json_mode:
-            if failures:
-                err_msgs = [f"{f['model_name']}: {f['error']}" for f in failures]
-                err_obj = {
-                    "message": f"{len(failures)} model(s) failed testing: {', '.join(err_msgs)}",
-                    "code": "MODEL_TESTS_FAILED"
-                }
-                output = {
-                    "success": False,
-                    "error": err_obj,
-                    "results": results
-                }
-            else:
-                output = {
-                    "success": True,
-                    "error": None,
-                    "results": results
-                }
-            print(json.dumps(output, indent=2))
-            if failures:
-                sys.exit(1)
-            else:
-                sys.exit(0)
+        results = run_endpoint_probes(active_endpoints, test_single_endpoint, lambda ep, error: {'ttft': None})
+        failures = report(results, "model(s) failed testing")
                 
         log("\n" + "=" * 120)
         log(f"{'Model Name':<45} | {'Status':<12} | {'TTFT (s)':<10} | {'Endpoint URL':<50}")
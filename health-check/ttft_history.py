@@ -0,0 +1,80 @@
+import math
+from array import array
+
+# Upper bounds (seconds) of the exported TTFT histogram buckets; +Inf is implicit
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+# Scales the median absolute deviation to a standard deviation for normally distributed data
+MAD_SCALE = 1.4826
+
+def quantiles(values, qs=(0.5, 0.9, 0.99)):
+    """Return {q: value} using linear interpolation over one sort of `values`."""
+    if not len(values):
+        return {q: math.nan for q in qs}
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    out = {}
+    for q in qs:
+        rank = q * last
+        lo = int(rank)
+        hi = min(lo + 1, last)
+        out[q] = ordered[lo] + (ordered[hi] - ordered[lo]) * (rank - lo)
+    return out
+
+class TTFTRing:
+    """Fixed-capacity ring of recent TTFT samples with cumulative histogram counters.
+
+    Samples live in a preallocated array('d'), so memory per model is constant no
+    matter how long the service runs. The histogram counters are cumulative since
+    process start, as Prometheus expects; quantiles only cover the ring window. An
+    EWMA of the samples tracks the current level for anomaly_score().
+    """
+
+    def __init__(self, capacity=256, buckets=TTFT_BUCKETS, ewma_alpha=0.3):
+        self.capacity = capacity
+        self.samples = array('d', bytes(8 * capacity))
+        self.size = 0
+        self.pos = 0
+        self.buckets = buckets
+        self.bucket_counts = array('Q', bytes(8 * len(buckets)))
+        self.count = 0
+        self.sum = 0.0
+        self.ewma_alpha = ewma_alpha
+        self.ewma = None
+
+    def add(self, value):
+        self.samples[self.pos] = value
+        self.pos = (self.pos + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+        self.count += 1
+        self.sum += value
+        self.ewma = value if self.ewma is None else self.ewma + self.ewma_alpha * (value - self.ewma)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+    def quantiles(self, qs=(0.5, 0.9, 0.99)):
+        """Return {q: value} over the samples in the window."""
+        return quantiles(self.samples[:self.size], qs)
+
+    def baseline(self):
+        """Return the (median, MAD) of the samples in the window."""
+        window = self.samples[:self.size]
+        median = quantiles(window, (0.5,))[0.5]
+        mad = quantiles([abs(v - median) for v in window], (0.5,))[0.5]
+        return median, mad
+
+    def anomaly_score(self, min_samples=20, min_scale=0.05):
+        """Return how many robust standard deviations the EWMA lies above the window's median.
+
+        The scale is MAD_SCALE * MAD, but at least `min_scale` times the median, so a model
+        whose TTFT barely varies is not flagged over a few milliseconds. None until the
+        window holds `min_samples` samples.
+        """
+        if self.size < min_samples:
+            return None
+        median, mad = self.baseline()
+        scale = max(MAD_SCALE * mad, min_scale * median, 1e-3)
+        return (self.ewma - median) / scale
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 import os
-import ssl
 import sys
-import time
 import json
 import argparse
 import urllib.request
 import urllib.error
-import concurrent.futures
+import functools
+
+from probe_engine import BATCH_SIZES, FULL_STREAM_REQUEST, RERANK_QUERY, PhaseTimer, add_usage, batch_documents, connection_state, deployment_from_headers, format_error, probe_batches, read_body_usage, read_chat_stream, run_probes, set_deadline, ssl_context, timed_urlopen
+from sharding import shard_filter
 
 def load_env(env_path, verbose=True):
     """Load environment variables from a .env file."""
@@ -36,15 +37,10 @@ def list_models(base_url, api_key, ssl_verify=True):
     
     req = urllib.request.Request(url, headers=headers, method='GET')
     
-    if not ssl_verify:
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-    else:
-        context = None
+    context = ssl_context(ssl_verify)
         
     try:
-        with urllib.request.urlopen(req, context=context, timeout=15) as response:
+        with timed_urlopen(req, context=context, timeout=15) as response:
             res_data = json.loads(response.read().decode('utf-8'))
             models = []
             if isinstance(res_data, dict) and 'data' in res_data:
@@ -63,8 +59,14 @@ def list_models(base_url, api_key, ssl_verify=True):
     except Exception as e:
         return None, f"Exception: {type(e).__name__} - {str(e)}"
 
-def measure_ttft(base_url, model_name, api_key, ssl_verify=True):
-    """Call a model (chat completion, embedding, or rerank) and measure latency/TTFT."""
+def measure_ttft(base_url, model_name, api_key, ssl_verify=True, full_stream=False):
+    """Call a model (chat completion, embedding, or rerank) and measure latency/TTFT.
+
+    Returns (success, ttft, error, phases, usage, stream, deployment) where phases holds the
+    per-phase timings of the last request attempt, usage the token usage reported by the
+    server, stream the decode stats of a full-stream chat probe (None otherwise) and
+    deployment the LiteLLM deployment that answered the last attempt, if the response said.
+    """
     model_lower = model_name.lower()
     
     if "embed" in model_lower:
@@ -90,8 +92,11 @@ def measure_ttft(base_url, model_name, api_key, ssl_verify=True):
                 {"role": "user", "content": "Respond with a single word hello"}
             ],
             "stream": True,
+            "stream_options": {"include_usage": True},
             "max_tokens": 10
         }
+        if full_stream:
+            payload.update(FULL_STREAM_REQUEST)
         is_streaming = True
 
     headers = {
@@ -100,99 +105,129 @@ def measure_ttft(base_url, model_name, api_key, ssl_verify=True):
         "User-Agent": "MyApp/1.0"
     }
 
-    if not ssl_verify:
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-    else:
-        context = None
+    context = ssl_context(ssl_verify)
+
+    timers = [PhaseTimer()]
+    deployments = [None]
 
     def execute_request(req_url, req_payload, stream_mode):
+        timer = PhaseTimer()
+        timers.append(timer)
+        deployments.append(None)
         req = urllib.request.Request(
             req_url,
             data=json.dumps(req_payload).encode('utf-8'),
             headers=headers,
             method='POST'
         )
-        t0 = time.time()
-        
-        if stream_mode:
+        try:
             # 30-second timeout to establish connection and receive stream
-            with urllib.request.urlopen(req, context=context, timeout=30) as response:
-                while True:
-                    line = response.readline()
-                    if not line:
-                        break
-                    line_str = line.decode('utf-8').strip()
-                    if line_str.startswith('data:'):
-                        data_str = line_str[5:].strip()
-                        if data_str == '[DONE]':
-                            break
-                        try:
-                            data = json.loads(data_str)
-                            choices = data.get('choices', [])
-                            if choices:
-                                delta = choices[0].get('delta', {})
-                                # Check for any generated content/token
-                                if delta.get('content') or delta.get('reasoning_content') or delta.get('text') or delta:
-                                    ttft = time.time() - t0
-                                    return True, ttft, None
-                        except json.JSONDecodeError:
-                            pass
-                return False, None, "Response stream ended without any tokens"
-        else:
-            with urllib.request.urlopen(req, context=context, timeout=30) as response:
-                response.read()
-                latency = time.time() - t0
-                return True, latency, None
+            with timed_urlopen(req, context=context, timeout=30, timer=timer) as response:
+                deployments[-1] = deployment_from_headers(response.headers)
+                if not stream_mode:
+                    body = response.read()
+                    latency = timer.mark("first_token")
+                    return True, latency, None, timer.phases, read_body_usage(body), None
+                ttft, usage, stream = read_chat_stream(response, timer, full_stream)
+                if ttft is None:
+                    return False, None, "Response stream ended without any tokens", timer.phases, None, None
+                return True, ttft, None, timer.phases, usage, stream
+        except urllib.error.HTTPError as e:
+            deployments[-1] = deployment_from_headers(e.headers)
+            raise
 
-    try:
-        if is_streaming:
-            try:
-                return execute_request(url, payload, stream_mode=True)
-            except urllib.error.HTTPError as e:
-                # If streaming fails, retry non-streaming
-                error_body = ""
-                try:
-                    error_body = e.read().decode('utf-8')
-                except Exception:
-                    pass
-                
-                payload["stream"] = False
+    def attempt():
+        try:
+            if is_streaming:
                 try:
-                    return execute_request(url, payload, stream_mode=False)
-                except Exception as retry_err:
-                    err_msg = error_body if error_body else str(e)
-                    return False, None, f"HTTP Error {e.code}: {e.reason} (Streaming failed: {err_msg}) - Non-streaming retry failed: {retry_err}"
-        else:
-            try:
-                return execute_request(url, payload, stream_mode=False)
-            except urllib.error.HTTPError as e:
-                if "rerank" in model_lower and e.code == 404 and "/v1/rerank" in url:
-                    alt_url = f"{base_url.rstrip('/')}/rerank"
+                    return execute_request(url, payload, stream_mode=True)
+                except urllib.error.HTTPError as e:
+                    # If streaming fails, retry non-streaming
+                    error_body = ""
                     try:
-                        return execute_request(alt_url, payload, stream_mode=False)
+                        error_body = e.read().decode('utf-8')
                     except Exception:
                         pass
-                raise e
-    except urllib.error.HTTPError as e:
+                
+                    payload["stream"] = False
+                    payload.pop("stream_options", None)
+                    try:
+                        return execute_request(url, payload, stream_mode=False)
+                    except Exception as retry_err:
+                        err_msg = error_body if error_body else str(e)
+                        return False, None, f"HTTP Error {e.code}: {e.reason} (Streaming failed: {err_msg}) - Non-streaming retry failed: {retry_err}", timers[-1].phases, None, None
+            else:
+                try:
+                    return execute_request(url, payload, stream_mode=False)
+                except urllib.error.HTTPError as e:
+                    if "rerank" in model_lower and e.code == 404 and "/v1/rerank" in url:
+                        alt_url = f"{base_url.rstrip('/')}/rerank"
+                        try:
+                            return execute_request(alt_url, payload, stream_mode=False)
+                        except Exception:
+                            pass
+                    raise e
+        except Exception as e:
+            return False, None, format_error(e), timers[-1].phases, None, None
+
+    success, ttft, error, phases, usage, stream = attempt()
+    return success, ttft, error, phases, usage, stream, deployments[-1]
+
+def measure_batch_throughput(base_url, model_name, api_key, ssl_verify=True, batch_sizes=BATCH_SIZES):
+    """Measure latency per batch and items/sec across batch sizes for an embedding or rerank model.
+
+    Sends batches of RAG-sized passages (inputs for embeddings, documents for rerank).
+    Returns (curve, usage, error) with curve and usage as from probe_engine.probe_batches();
+    all three are None for other models.
+    """
+    model_lower = model_name.lower()
+
+    if "embed" in model_lower:
+        url = f"{base_url.rstrip('/')}/v1/embeddings"
+        def payload_for(n):
+            return {"model": model_name, "input": batch_documents(n)}
+    elif "rerank" in model_lower:
+        url = f"{base_url.rstrip('/')}/v1/rerank"
+        def payload_for(n):
+            return {"model": model_name, "query": RERANK_QUERY, "documents": batch_documents(n)}
+    else:
+        return None, None, None
+
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+        "User-Agent": "MyApp/1.0"
+    }
+
+    context = ssl_context(ssl_verify)
+
+    try:
         try:
-            error_body = e.read().decode('utf-8')
-            return False, None, f"HTTP Error {e.code}: {e.reason} - Details: {error_body}"
-        except Exception:
-            return False, None, f"HTTP Error {e.code}: {e.reason}"
-    except urllib.error.URLError as e:
-        return False, None, f"URL Error: {e.reason}"
+            return probe_batches(url, payload_for, headers, context=context, batch_sizes=batch_sizes) + (None,)
+        except urllib.error.HTTPError as e:
+            if "rerank" in model_lower and e.code == 404:
+                alt_url = f"{base_url.rstrip('/')}/rerank"
+                return probe_batches(alt_url, payload_for, headers, context=context, batch_sizes=batch_sizes) + (None,)
+            raise
     except Exception as e:
-        return False, None, f"Exception: {type(e).__name__} - {str(e)}"
+        return None, None, format_error(e)
 
 def main():
     parser = argparse.ArgumentParser(description="Test Zuplo endpoints on api.publicai.co")
     parser.add_argument("--insecure", action="store_true", help="Bypass SSL verification")
     parser.add_argument("--url", default="https://api.publicai.co", help="Base URL of Zuplo service")
     parser.add_argument("--workers", type=int, default=10, help="Number of parallel workers to use")
+    parser.add_argument("--models", help="Comma-separated list of models to test (default: all)")
+    parser.add_argument("--shard", help="Only probe the models this replica owns on the hash ring of --shard-members (see sharding.py)")
+    parser.add_argument("--shard-members", default="", help="Comma-separated replicas sharing the models, with --shard")
+    parser.add_argument("--full-stream", action="store_true", help="Read every stream to the end and report decode speed")
+    parser.add_argument("--batch-throughput", action="store_true", help="Also measure embedding/rerank throughput across --batch-sizes for the models whose probe succeeded")
+    parser.add_argument("--batch-sizes", default=",".join(map(str, BATCH_SIZES)), help="Comma-separated batch sizes of embedding/rerank throughput probes (empty disables)")
+    parser.add_argument("--deadline", type=float, default=0, help="Seconds the whole run may take; unfinished probes are reported as timeout (0: no limit)")
     parser.add_argument("-json", "--json", action="store_true", help="Output results in JSON format")
     args = parser.parse_args()
+    set_deadline(args.deadline)
+    batch_sizes = [int(n) for n in args.batch_sizes.split(",") if n.strip()] if args.batch_throughput else []
 
     json_mode = args.json
 
@@ -230,39 +265,65 @@ def main():
             raise RuntimeError("No models returned by Zuplo.")
             
         log(f"Found {len(models)} models: {', '.join(models)}")
+        if args.models:
+            wanted = set(args.models.split(","))
+            models = [m for m in models if m in wanted]
+            log(f"Restricting tests to {len(models)} requested models")
+        if args.shard:
+            owns = shard_filter(args.shard, args.shard_members)
+            models = [m for m in models if owns(m)]
+            log(f"Restricting tests to the {len(models)} models of shard {args.shard}")
         log(f"Testing {len(models)} models in parallel using {args.workers} workers...")
         log("-" * 120)
         
         results = [None] * len(models)
         
         def test_single_model(idx, model):
-            success, ttft, error = measure_ttft(args.url, model, api_key, ssl_verify=ssl_verify)
+            success, ttft, error, phases, usage, stream, deployment = measure_ttft(args.url, model, api_key, ssl_verify=ssl_verify, full_stream=args.full_stream)
+            via = f" via {deployment['api_base'] or deployment['id']}" if deployment else ""
             if success:
-                log(f"[{idx}/{len(models)}] {model}: SUCCESS (TTFT: {ttft:.3f}s)")
+                log(f"[{idx}/{len(models)}] {model}: SUCCESS (TTFT: {ttft:.3f}s{via})")
             else:
-                log(f"[{idx}/{len(models)}] {model}: FAILED (Error: {error})")
+                log(f"[{idx}/{len(models)}] {model}: FAILED{via} (Error: {error})")
+            batches, batch_error = None, None
+            if batch_sizes and success:
+                batches, batch_usage, batch_error = measure_batch_throughput(args.url, model, api_key, ssl_verify=ssl_verify, batch_sizes=batch_sizes)
+                usage = add_usage(usage, batch_usage)
             return {
                 'model': model,
                 'success': success,
                 'ttft': ttft,
+                'phases': phases,
+                'connection': connection_state(phases),
+                'usage': usage,
+                'stream': stream,
+                'deployment': deployment,
+                'batches': batches,
+                'batch_error': batch_error,
                 'error': error
             }
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
-            futures = {executor.submit(test_single_model, idx, model): idx - 1 for idx, model in enumerate(models, 1)}
-            for future in concurrent.futures.as_completed(futures):
-                idx_zero = futures[future]
-                try:
-                    results[idx_zero] = future.result()
-                except Exception as e:
-                    model = models[idx_zero]
-                    log(f"[{idx_zero+1}/{len(models)}] {model}: FAILED (Exception: {e})")
-                    results[idx_zero] = {
-                        'model': model,
-                        'success': False,
-                        'ttft': None,
-                        'error': f"Thread Exception: {e}"
-                    }
+        tasks = [functools.partial(test_single_model, idx, model) for idx, model in enumerate(models, 1)]
+        for idx_zero, (status, value) in enumerate(run_probes(tasks, args.workers)):
+            model = models[idx_zero]
+            if status == "done":
+                results[idx_zero] = value
+            elif status == "error":
+                log(f"[{idx_zero+1}/{len(models)}] {model}: FAILED (Exception: {value})")
+                results[idx_zero] = {
+                    'model': model,
+                    'success': False,
+                    'ttft': None,
+                    'error': f"Thread Exception: {value}"
+                }
+            else:
+                log(f"[{idx_zero+1}/{len(models)}] {model}: TIMEOUT (run deadline of {args.deadline:g}s reached)")
+                results[idx_zero] = {
+                    'model': model,
+                    'success': False,
+                    'ttft': None,
+                    'error': f"timeout: probe did not finish within the {args.deadline:g}s run deadline"
+                }
             
         failures = [r for r in results if not r['success']]
 